@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# End-to-end benchmark of a dashboard refresh cycle against canned provider payloads
+# and the simulated panel. Reports per-stage timings of repeated runs, optionally as
+# JSON, and checks them against regression thresholds.
+#
+#   python benchmarks/bench_cycle.py --runs 10 --json cycle.json --check
+#
+# thresholds.json holds the limits for the machine the suite is tracked on; regenerate
+# it there with --update-thresholds after an intended performance change.
+import sys
+import os
+import argparse
+import json
+import logging
+import statistics
+import tempfile
+import time
+
+libdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+benchdir = os.path.dirname(os.path.realpath(__file__))
+PAYLOADS = os.path.join(benchdir, 'payloads.json')
+THRESHOLDS = os.path.join(benchdir, 'thresholds.json')
+
+# Headroom applied to the measured medians by --update-thresholds: a factor, plus
+# a fixed slack in ms so sub-millisecond stages do not trip on noise
+THRESHOLD_HEADROOM = 2.0
+THRESHOLD_SLACK = 1.0
+
+STAGES = ['fetch', 'weather', 'forecast', 'bus', 'tasks', 'render', 'getbuffers', 'spi_push', 'busy_wait', 'cycle']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10, help='measured runs per scenario')
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help='simulator time scale for SPI and busy waits (0: instant)')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated provider latency in seconds')
+    parser.add_argument('--json', metavar='PATH', help='write the results as JSON to PATH')
+    parser.add_argument('--check', action='store_true', help='fail if a stage median exceeds its threshold')
+    parser.add_argument('--update-thresholds', action='store_true',
+                        help=f'write medians with headroom to {os.path.basename(THRESHOLDS)}')
+    return parser.parse_args()
+
+
+def install_payloads(payloads, latency):
+    # Replaces the network fetches with canned payloads. Each departures fetch shifts
+    # the first departure by a minute so the bus pane changes between runs.
+    import departures
+    import todoist
+    import weather
+
+    calls = {'departures': 0}
+
+    def canned(name):
+        def fetch():
+            if latency:
+                time.sleep(latency)
+            if name == 'departures':
+                calls[name] += 1
+                first = dict(payloads[name][0], time=f"08:{12 + calls[name] % 40:02d}")
+                return [first] + payloads[name][1:]
+            return payloads[name]
+        return fetch
+
+    weather.fetch_weather = canned('weather')
+    departures.fetch_departures = canned('departures')
+    todoist.fetch_tasks = canned('tasks')
+
+
+def run_cycle(dashboard, cache, epd, compositor, panes, fonts, partial, cache_dir):
+    timings = {}
+    start = time.perf_counter()
+
+    # A fresh cache per run, so every run fetches
+    dashboard.provider_cache = cache.ProviderCache(tempfile.mkdtemp(dir=cache_dir))
+    with dashboard.timed(timings, 'fetch'):
+        data = dashboard.fetch_all()
+
+    with dashboard.timed(timings, 'render'):
+        image = dashboard.render_frame(epd, fonts, data, timings, panes)
+
+    with dashboard.timed(timings, 'getbuffers'):
+        planes = epd.getbuffers_tricolor(image)
+
+    busy_before = epd.total_busy_time
+    with dashboard.timed(timings, 'push'):
+        compositor.push(*planes, force_full=not partial)
+    timings['busy_wait'] = epd.total_busy_time - busy_before
+    timings['spi_push'] = timings.pop('push') - timings['busy_wait']
+
+    timings['cycle'] = time.perf_counter() - start
+    return timings
+
+
+def summarize(samples):
+    return {stage: {
+        'min': min(s[stage] for s in samples) * 1000,
+        'median': statistics.median(s[stage] for s in samples) * 1000,
+        'max': max(s[stage] for s in samples) * 1000,
+    } for stage in STAGES}
+
+
+def check(results, thresholds):
+    failures = []
+    for scenario, stages in thresholds.items():
+        for stage, limit in stages.items():
+            median = results['scenarios'].get(scenario, {}).get(stage, {}).get('median')
+            if median is not None and median > limit:
+                failures.append(f"{scenario}/{stage}: median {median:.1f} ms > threshold {limit:.1f} ms")
+    return failures
+
+
+def main():
+    args = parse_args()
+
+    # The simulator must be selected before the driver talks to the panel
+    os.environ.setdefault('EPD_BACKEND', 'simulator')
+    os.environ['EPD_SIM_TIME_SCALE'] = str(args.time_scale)
+    os.environ.setdefault('EPD_SIM_DIR', tempfile.mkdtemp(prefix='bench-epd-'))
+    os.environ.setdefault('EPD_SIM_SNAPSHOTS', '0')
+    os.environ.setdefault('EPD_STATE_FILE', os.path.join(os.environ['EPD_SIM_DIR'], 'panel.state'))
+
+    import cache
+    import dashboard
+    from compositor import FrameCompositor
+    from fonts import bbox_cache_stats, preload
+    from panes import PaneCompositor
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with open(PAYLOADS, encoding='utf-8') as f:
+        install_payloads(json.load(f), args.latency)
+
+    epd = dashboard.epd7in5b_V2.EPD()
+    epd.init()
+    fonts = preload(48, 24, 18)
+
+    results = {
+        'backend': os.environ['EPD_BACKEND'],
+        'time_scale': args.time_scale,
+        'runs': args.runs,
+        'scenarios': {},
+        'pane_cache': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='bench-cache-') as cache_dir:
+        for scenario in ('full', 'partial'):
+            compositor = FrameCompositor(epd, max_partials=args.runs + 1)
+            panes = PaneCompositor((epd.width, epd.height))
+            # Warm-up run, also gives the partial scenario a frame to diff against
+            run_cycle(dashboard, cache, epd, compositor, panes, fonts, False, cache_dir)
+            used = [panes]
+            samples = []
+            for _ in range(args.runs):
+                if scenario == 'full':
+                    # Every pane is drawn from scratch, like the first frame after a start
+                    panes = PaneCompositor((epd.width, epd.height))
+                    used.append(panes)
+                samples.append(run_cycle(dashboard, cache, epd, compositor, panes, fonts, scenario == 'partial', cache_dir))
+            results['scenarios'][scenario] = summarize(samples)
+            results['pane_cache'][scenario] = {'hits': sum(sum(p.hits.values()) for p in used),
+                                               'misses': sum(sum(p.misses.values()) for p in used)}
+    dashboard.epd7in5b_V2.epdconfig.module_exit()
+    results['bbox_cache'] = bbox_cache_stats()
+
+    print(f"backend: {results['backend']}, time scale: {args.time_scale}, {args.runs} runs, ms")
+    print(f"{'stage':>12} " + " ".join(f"{s + ' med':>12} {s + ' max':>12}" for s in results['scenarios']))
+    for stage in STAGES:
+        print(f"{stage:>12} " + " ".join(
+            f"{r[stage]['median']:>12.2f} {r[stage]['max']:>12.2f}" for r in results['scenarios'].values()))
+    print(f"text measurement cache hit rate: {results['bbox_cache']['hit_rate']:.1%}")
+    for scenario, counts in results['pane_cache'].items():
+        print(f"{scenario} pane cache: {counts['hits']} hits, {counts['misses']} misses")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_thresholds:
+        thresholds = {scenario: {stage: round(r[stage]['median'] * THRESHOLD_HEADROOM + THRESHOLD_SLACK, 2)
+                                 for stage in STAGES if stage != 'busy_wait'}
+                      for scenario, r in results['scenarios'].items()}
+        with open(THRESHOLDS, 'w') as f:
+            json.dump(thresholds, f, indent=2)
+            f.write('\n')
+
+    if args.check:
+        with open(THRESHOLDS) as f:
+            failures = check(results, json.load(f))
+        for failure in failures:
+            print("REGRESSION " + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
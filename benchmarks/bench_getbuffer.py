@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Measures the per-frame cost of packing the black and red images, or one tri-colour
+# image, into panel planes.
+import sys
+import os
+import timeit
+from PIL import Image, ImageDraw
+
+libdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+import epd7in5b_V2
+
+RUNS = 20
+
+
+def legacy_pack(epd, imageblack, imagered):
+    # The original getbuffer() + display() path: XOR every byte of both planes,
+    # then XOR the black plane back again
+    planes = []
+    for image in (imageblack, imagered):
+        buf = bytearray(image.convert('1').tobytes('raw'))
+        for i in range(len(buf)):
+            buf[i] ^= 0xFF
+        planes.append(buf)
+    for i in range(len(planes[0])):
+        planes[0][i] ^= 0xFF
+    return planes[0], planes[1]
+
+
+def main():
+    epd = epd7in5b_V2.EPD()
+    black = Image.new('1', (epd.width, epd.height), 255)
+    red = Image.new('1', (epd.width, epd.height), 255)
+    ImageDraw.Draw(black).rectangle((10, 10, 300, 200), fill=0)
+    ImageDraw.Draw(red).ellipse((400, 100, 600, 300), fill=0)
+
+    # The same frame drawn once into a tri-colour palette image
+    tricolor = Image.new('P', (epd.width, epd.height), epd7in5b_V2.WHITE)
+    tricolor.putpalette(epd7in5b_V2.PALETTE)
+    ImageDraw.Draw(tricolor).rectangle((10, 10, 300, 200), fill=epd7in5b_V2.BLACK)
+    ImageDraw.Draw(tricolor).ellipse((400, 100, 600, 300), fill=epd7in5b_V2.RED)
+
+    assert legacy_pack(epd, black, red) == epd.getbuffers(black, red) == epd.getbuffers_tricolor(tricolor)
+
+    for name, pack in (("legacy", lambda: legacy_pack(epd, black, red)),
+                       ("getbuffers", lambda: epd.getbuffers(black, red)),
+                       ("tricolor", lambda: epd.getbuffers_tricolor(tricolor))):
+        per_frame = min(timeit.repeat(pack, number=1, repeat=RUNS))
+        print(f"{name:>10}: {per_frame * 1000:8.3f} ms/frame")
+
+
+if __name__ == '__main__':
+    main()
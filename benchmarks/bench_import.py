@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Measures the cost of importing the driver, of selecting the hardware backend on
+# first use, and of the old shell pipeline used to detect a Raspberry Pi.
+import sys
+import os
+import subprocess
+import time
+
+libdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+RUNS = 5
+
+IMPORT = "import time; t = time.perf_counter(); import epd7in5b_V2; print(time.perf_counter() - t)"
+SELECT = ("import time; import epd7in5b_V2; t = time.perf_counter(); "
+          "epd7in5b_V2.epdconfig.select_backend(); print(time.perf_counter() - t)")
+
+
+def run(code):
+    # Each sample runs in a fresh interpreter so nothing is already imported
+    samples = []
+    for _ in range(RUNS):
+        out = subprocess.run([sys.executable, '-c', code], cwd=libdir, capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(samples)
+
+
+def legacy_detection():
+    samples = []
+    for _ in range(RUNS):
+        t = time.perf_counter()
+        subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True,
+                         stdout=subprocess.PIPE, text=True).communicate()
+        samples.append(time.perf_counter() - t)
+    return min(samples)
+
+
+def model_detection():
+    sys.path.append(libdir)
+    import epdconfig
+    samples = []
+    for _ in range(RUNS):
+        t = time.perf_counter()
+        epdconfig.detect_backend()
+        samples.append(time.perf_counter() - t)
+    return min(samples)
+
+
+def main():
+    for name, seconds in (("import epd7in5b_V2", run(IMPORT)),
+                          ("select_backend()", run(SELECT)),
+                          ("cat /proc/cpuinfo | grep", legacy_detection()),
+                          ("detect_backend()", model_detection())):
+        if seconds is None:
+            print(f"{name:>26}: failed (no usable backend on this machine?)")
+        else:
+            print(f"{name:>26}: {seconds * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Measures the effective SPI throughput of pushing a full frame (black + red planes)
+# to the panel RAM, for a range of SPI clocks and chunk sizes. No refresh is triggered.
+import sys
+import os
+import argparse
+import time
+
+libdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+import epdconfig
+import epd7in5b_V2
+
+
+def push_frame(epd, black, red):
+    start = time.perf_counter()
+    epd.send_command_with_data(0x10, black)
+    epd.send_command_with_data(0x13, red)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--speeds', default='2000000,4000000,8000000,16000000',
+                        help='comma separated SPI clocks in Hz')
+    parser.add_argument('--chunks', default='',
+                        help='comma separated chunk sizes in bytes (default: the backend default)')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    epd = epd7in5b_V2.EPD()
+    if epdconfig.module_init() != 0:
+        sys.exit("module_init failed")
+
+    plane_size = epd.width // 8 * epd.height
+    black = bytes(range(256)) * (plane_size // 256) + bytes(plane_size % 256)
+    red = bytes(plane_size)
+    frame_bytes = len(black) + len(red)
+
+    backend = type(epdconfig.implementation).__name__
+    chunks = [int(c) for c in args.chunks.split(',') if c] or [None]
+    print(f"backend: {backend}, frame: {frame_bytes} bytes, best of {args.runs} runs")
+    print(f"{'speed Hz':>10} {'chunk':>6} {'ms/frame':>9} {'KB/s':>8} {'of clock':>8}")
+    try:
+        for speed in [int(s) for s in args.speeds.split(',') if s]:
+            for chunk in chunks:
+                epdconfig.spi_configure(speed_hz=speed, chunk_size=chunk)
+                best = min(push_frame(epd, black, red) for _ in range(args.runs))
+                throughput = frame_bytes / best
+                used_chunk = getattr(epdconfig.implementation, 'spi_chunk_size', '-')
+                print(f"{speed:>10} {used_chunk:>6} {best * 1000:>9.1f} {throughput / 1024:>8.1f} "
+                      f"{throughput * 8 / speed:>8.0%}")
+    finally:
+        epdconfig.module_exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failures after which the circuit opens
+FAILURE_THRESHOLD = 2
+
+# Seconds the circuit stays open after it first opens, doubling with every failed
+# retry up to MAX_BACKOFF. The actual wait is drawn from [backoff / 2, backoff] so
+# retries of several providers do not line up.
+BASE_BACKOFF = 60
+MAX_BACKOFF = 30 * 60
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a provider whose circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing provider for a while.
+
+    The circuit opens after threshold consecutive failures. While open, calls
+    raise CircuitOpenError without reaching the provider. Once the backoff has
+    passed, a single call is let through as a trial while others are still
+    refused: success closes the circuit, failure opens it again with twice the
+    backoff.
+    """
+
+    def __init__(self, name, threshold=FAILURE_THRESHOLD, base_backoff=BASE_BACKOFF,
+                 max_backoff=MAX_BACKOFF, clock=time.monotonic):
+        self.name = name
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.failures = 0
+        self.opened = 0       # times opened in a row, for the backoff
+        self.retry_at = None  # while open, when the next trial call is let through
+        self.last_error = None
+        self._trial = False   # a half-open trial call is in flight
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.retry_at is None:
+                return 'closed'
+            return 'open' if self.clock() < self.retry_at else 'half_open'
+
+    def allow(self):
+        """
+        Returns False while the circuit is open, or a trial call is already in
+        flight, and calls should not be made.
+        """
+        with self._lock:
+            return self.retry_at is None or (self.clock() >= self.retry_at and not self._trial)
+
+    def _acquire(self):
+        # Like allow(), but claims the trial call when half-open
+        with self._lock:
+            if self.retry_at is None:
+                return True
+            if self.clock() < self.retry_at or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.retry_at is not None:
+                logger.info(f"{self.name}: recovered, closing circuit")
+            self.failures = 0
+            self.opened = 0
+            self.retry_at = None
+            self.last_error = None
+            self._trial = False
+
+    def failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self._trial = False
+            if self.retry_at is None and self.failures < self.threshold:
+                return
+            backoff = min(self.base_backoff * 2 ** self.opened, self.max_backoff)
+            delay = random.uniform(backoff / 2, backoff)
+            self.opened += 1
+            self.retry_at = self.clock() + delay
+            logger.warning(f"{self.name}: {self.failures} failures in a row ({error}), retrying in {delay:.0f}s")
+
+    def wrap(self, fetch):
+        """
+        Returns fetch guarded by the circuit.
+        """
+        def guarded_fetch():
+            if not self._acquire():
+                raise CircuitOpenError(f"{self.name} circuit open")
+            try:
+                result = fetch()
+            except Exception as e:
+                self.failure(e)
+                raise
+            self.success()
+            return result
+        return guarded_fetch
+
+    def health(self):
+        """
+        Returns the state of the circuit as a JSON-serialisable dict.
+        """
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'failures': self.failures,
+                'retry_in': max(self.retry_at - self.clock(), 0) if self.retry_at is not None else 0,
+                'last_error': self.last_error,
+            }
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("EINK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "e-ink"))
+
+
+class ProviderCache:
+    """
+    On-disk cache of provider payloads with a TTL and stale-while-revalidate.
+
+    Entries younger than ttl are served as is. Entries older than ttl but within
+    ttl + max_stale are served while a background thread refetches them. Anything
+    older is fetched synchronously. Entries are persisted as JSON files so they
+    survive process restarts.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+
+    def _key(self, provider, params):
+        if not params:
+            return provider
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        return f"{provider}-{digest}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            return self._entries.setdefault(key, entry)
+
+    def _store(self, key, payload):
+        entry = {"fetched_at": time.time(), "payload": payload}
+        with self._lock:
+            self._entries[key] = entry
+        path = self._path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"Could not persist cache entry {key}: {e}")
+
+    def _refresh(self, key, fetch):
+        try:
+            self._store(key, fetch())
+        except Exception as e:
+            logger.warning(f"Background refresh of {key} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.pop(key).set()
+
+    def _start_refresh(self, key, fetch):
+        with self._lock:
+            done = self._refreshing.get(key)
+            if done is None:
+                done = self._refreshing[key] = threading.Event()
+                threading.Thread(target=self._refresh, args=(key, fetch), name=f"refresh-{key}", daemon=True).start()
+        return done
+
+    def get(self, provider, fetch, ttl, max_stale=0, params=None, wait=0):
+        """
+        Returns the payload of provider, calling fetch() when the cached entry is missing or stale.
+        A stale entry is returned right away, or after waiting up to wait seconds for its refresh.
+        Exceptions from a synchronous fetch propagate to the caller.
+        """
+        key = self._key(provider, params)
+        entry = self._load(key)
+        age = time.time() - entry["fetched_at"] if entry else None
+
+        if age is not None and age < ttl:
+            return entry["payload"]
+
+        if age is None or age >= ttl + max_stale:
+            payload = fetch()
+            self._store(key, payload)
+            return payload
+
+        logger.debug(f"Serving {key} {age:.0f}s old, refreshing in background")
+        done = self._start_refresh(key, fetch)
+        if wait > 0 and done.wait(wait):
+            entry = self._load(key)
+        return entry["payload"]
+
+    def peek(self, provider, params=None):
+        """
+        Returns the cached payload of provider whatever its age, or None if there is none.
+        """
+        entry = self._load(self._key(provider, params))
+        return entry["payload"] if entry else None
+
+    def put(self, provider, payload, params=None):
+        """
+        Stores payload as freshly fetched, e.g. data pushed by another process.
+        """
+        self._store(self._key(provider, params), payload)
+
+    def invalidate(self, provider, params=None):
+        """
+        Drops the cached entry of provider, so the next get() fetches synchronously.
+        """
+        key = self._key(provider, params)
+        with self._lock:
+            self._entries.pop(key, None)
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove cache entry {key}: {e}")
+
+    def age(self, provider, params=None):
+        """
+        Returns the age in seconds of the cached entry of provider, or None if there is none.
+        """
+        entry = self._load(self._key(provider, params))
+        return time.time() - entry["fetched_at"] if entry else None
@@ -0,0 +1,157 @@
+import logging
+import time
+
+from epd7in5b_V2 import INVERT
+
+logger = logging.getLogger(__name__)
+
+# Full refresh after this many partial refreshes, to clear the ghosting they accumulate
+MAX_PARTIALS = 10
+
+# Dirty row bands closer than this many rows are pushed as one rectangle
+MERGE_GAP = 16
+
+# Fall back to a full refresh when the dirty rectangles cover more than this share of the screen
+MAX_PARTIAL_AREA = 0.5
+
+
+def _row_diff(old_row, new_row):
+    # Returns the first and last (exclusive) differing byte of two rows, or None
+    if old_row == new_row:
+        return None
+    nbytes = len(new_row)
+    diff = int.from_bytes(old_row, 'big') ^ int.from_bytes(new_row, 'big')
+    first = nbytes - 1 - (diff.bit_length() - 1) // 8
+    last = nbytes - 1 - ((diff & -diff).bit_length() - 1) // 8
+    return first, last + 1
+
+
+def dirty_rects(old, new, width, height, merge_gap=MERGE_GAP):
+    """
+    Returns the byte-aligned rectangles (x0, y0, x1, y1) in which two planes differ.
+    x0 and x1 are pixel columns on byte boundaries, x1 and y1 are exclusive.
+    """
+    row_bytes = width // 8
+    old = memoryview(old)
+    new = memoryview(new)
+
+    rects = []
+    band = None  # [x0_byte, y0, x1_byte, y1] of the band being grown
+    for y in range(height):
+        start = y * row_bytes
+        cols = _row_diff(old[start:start + row_bytes], new[start:start + row_bytes])
+        if cols is None:
+            continue
+        if band is not None and y - band[3] <= merge_gap:
+            band[0] = min(band[0], cols[0])
+            band[2] = max(band[2], cols[1])
+            band[3] = y + 1
+        else:
+            if band is not None:
+                rects.append(band)
+            band = [cols[0], y, cols[1], y + 1]
+    if band is not None:
+        rects.append(band)
+
+    return [(x0 * 8, y0, x1 * 8, y1) for x0, y0, x1, y1 in rects]
+
+
+def crop_plane(plane, width, rect):
+    """
+    Returns the bytes of plane inside a byte-aligned rectangle, row by row.
+    """
+    x0, y0, x1, y1 = rect
+    row_bytes = width // 8
+    plane = memoryview(plane)
+    return b''.join(plane[y * row_bytes + x0 // 8:y * row_bytes + x1 // 8] for y in range(y0, y1))
+
+
+class FrameCompositor:
+    """
+    Pushes frames to the panel, using partial refreshes of the dirty rectangles
+    of the black plane where possible.
+
+    A full refresh is used for the first frame, when the red plane changed (partial
+    mode only drives black and white), when the dirty area is large, after
+    max_partials partial refreshes in a row, for changed frames pushed with
+    allow_partial=False, and for unchanged frames once the panel's
+    full_refresh_interval has passed.
+    """
+
+    def __init__(self, epd, max_partials=MAX_PARTIALS):
+        self.epd = epd
+        self.max_partials = max_partials
+        self.black = None
+        self.red = None
+        self.partials = 0
+        self.partial_mode = False
+
+    def reset(self):
+        """
+        Forgets the panel state, e.g. after the panel was reset. The next push is a full refresh.
+        """
+        self.black = None
+        self.red = None
+        self.partials = 0
+        self.partial_mode = False
+
+    def full_refresh_due(self):
+        """
+        Returns True when the panel's last full refresh is older than its
+        full_refresh_interval, so even an unchanged frame is refreshed again.
+        """
+        last = self.epd.last_full_refresh
+        return last is None or time.monotonic() - last >= self.epd.full_refresh_interval
+
+    def push(self, black, red, force_full=False, allow_partial=True):
+        """
+        Shows the planes returned by EPD.getbuffers() on the panel.
+        With allow_partial=False a changed frame is shown with a full refresh.
+        Returns 'full', 'partial' or 'skip' depending on what was done.
+        """
+        width, height = self.epd.width, self.epd.height
+        if self.black is None or force_full or red != self.red or self.partials >= self.max_partials:
+            return self._full(black, red, force_full)
+        if not allow_partial and black != self.black:
+            return self._full(black, red, force_full)
+
+        rects = dirty_rects(self.black, black, width, height)
+        if not rects:
+            if self.full_refresh_due():
+                logger.debug("Frame unchanged, but a full refresh is due")
+                return self._full(black, red, True)
+            logger.debug("No dirty rectangles, skipping refresh")
+            return 'skip'
+
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects)
+        if area > MAX_PARTIAL_AREA * width * height:
+            return self._full(black, red, force_full)
+
+        if not self.partial_mode:
+            self.epd.init_part()
+            self.epd.partFlag = 1
+            self.partial_mode = True
+
+        # In partial mode the panel takes the black plane with 1=black
+        inverted = black.translate(INVERT)
+        for rect in rects:
+            logger.debug(f"Partial refresh of {rect}")
+            self.epd.display_Partial(crop_plane(inverted, width, rect), *rect)
+        self.epd.save_state(black, self.red, persist=False)
+
+        self.black = black
+        self.partials += 1
+        return 'partial'
+
+    def _full(self, black, red, force):
+        if self.partial_mode:
+            self.epd.init()
+            self.partial_mode = False
+            force = True
+
+        refreshed = self.epd.display_frame(black, red, force=force)
+        self.black = black
+        self.red = red
+        if refreshed:
+            self.partials = 0
+        return 'full' if refreshed else 'skip'
@@ -0,0 +1,93 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from cache import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Unix domain socket the dashboard listens on for commands
+CONTROL_SOCKET = os.getenv("EINK_CONTROL_SOCKET", os.path.join(CACHE_DIR, "control.sock"))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One JSON request per line, answered with one JSON response per line
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object")
+                response = self.server.handle_command(request)
+            except Exception as e:
+                logger.warning(f"Control command failed: {e}")
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves commands on a Unix domain socket. handle_command(request) is called
+    with each decoded request dict and returns the response dict; exceptions
+    are returned as {"ok": false, "error": ...}.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handle_command, path=CONTROL_SOCKET):
+        self.handle_command = handle_command
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # A socket left behind by a previous process would make bind() fail
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o660)
+
+    def start(self):
+        """
+        Serves requests on a background thread.
+        """
+        threading.Thread(target=self.serve_forever, name="control", daemon=True).start()
+        logger.info(f"Listening for commands on {self.server_address}")
+        return self
+
+
+def request(command, path=CONTROL_SOCKET, timeout=10):
+    """
+    Sends one command dict to the dashboard and returns its response.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(command, ensure_ascii=False).encode("utf-8") + b"\n")
+            f.flush()
+            return json.loads(f.readline())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send a command to the running dashboard")
+    commands = parser.add_subparsers(dest="cmd", required=True)
+    refresh = commands.add_parser("refresh", help="redraw a pane with its provider's current data")
+    refresh.add_argument("pane", nargs="?", default="all", help="weather, forecast, bus, tasks or all")
+    invalidate = commands.add_parser("invalidate", help="drop a provider's cached data and refetch it")
+    invalidate.add_argument("provider", help="weather, departures or tasks")
+    push = commands.add_parser("push", help="show a payload in place of a provider's data")
+    push.add_argument("provider", help="weather, departures or tasks")
+    push.add_argument("data", help="JSON payload, as the provider would return it")
+    commands.add_parser("status", help="print metrics and scheduler state")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    command = {key: value for key, value in vars(args).items() if value is not None}
+    if args.cmd == "push":
+        command["data"] = json.loads(args.data)
+    print(json.dumps(request(command), indent=2, ensure_ascii=False))
@@ -2,12 +2,11 @@
 # -*- coding:utf-8 -*-
 import sys
 import os
-import subprocess
-import json
 import logging
 import time
-import re
-from PIL import Image, ImageDraw, ImageFont
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from PIL import ImageDraw
 
 picdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pic')
 libdir = os.path.dirname(os.path.realpath(__file__))
@@ -15,90 +14,271 @@ if os.path.exists(libdir):
     sys.path.append(libdir)
 
 import epd7in5b_V2
+import cache
+import departures
+import sessions
+import todoist
+import weather
+from breaker import CircuitBreaker, CircuitOpenError
+from compositor import FrameCompositor
+from control import ControlServer
+from epd7in5b_V2 import BLACK, RED, WHITE
+from fonts import bbox, bbox_cache_stats, get_font, preload
+from framebuffer import FrameBuffer, FrameBufferWriter
+from layout import layout_cache_stats, layout_task
+from metrics import Metrics
+from panes import PaneCompositor
+from scheduler import Scheduler
 
 logging.basicConfig(level=logging.DEBUG)
 
-def get_tasks():
+# "panel" drives the e-Paper directly, "framebuffer" writes frames into the shared
+# framebuffer for displayd.py to show
+DISPLAY = os.getenv("EINK_DISPLAY", "panel")
+
+# Refresh interval in seconds, priority (lower runs first) and whether an update is
+# shown with a full refresh, per provider. Departures change by the minute and only
+# touch the bus pane, so they are pushed with partial refreshes.
+SCHEDULE = {
+    'departures': (60, 0, False),
+    'tasks': (10 * 60, 1, True),
+    'weather': (30 * 60, 2, True),
+}
+
+# Per-provider deadline in seconds, counted from the start of a cycle
+PROVIDER_DEADLINES = {
+    'weather': 15,
+    'departures': 15,
+    'tasks': 20,
+}
+
+# Cache TTL and max-stale in seconds per provider. The weather and tasks TTLs are
+# well below their SCHEDULE intervals: a job can run up to the scheduler's batch
+# window early and its entry is stamped after the fetch, so an entry the size of the
+# interval would still be fresh when the job next runs and every other run would be
+# served from cache. Departed buses are dropped from the departures window when it
+# is read, so a stale window is still of use; the TTL only picks up changed delays.
+CACHE_POLICY = {
+    'weather': (25 * 60, 6 * 60 * 60),
+    'departures': (10 * 60, 20 * 60),
+    'tasks': (8 * 60, 24 * 60 * 60),
+}
+
+# A departures window running low is refetched once it is this many seconds old
+DEPARTURES_LOW_TTL = 60
+
+# Checks the shape of provider data pushed over the control socket
+PAYLOAD_VALIDATORS = {
+    'weather': weather.validate,
+    'departures': departures.validate,
+    'tasks': todoist.validate,
+}
+
+# Provider each pane is drawn from
+PANE_PROVIDERS = {
+    'weather': 'weather',
+    'forecast': 'weather',
+    'bus': 'departures',
+    'tasks': 'tasks',
+}
+
+provider_cache = cache.ProviderCache()
+
+# While a provider's circuit is open it is not called and its cached data is served
+breakers = {name: CircuitBreaker(name) for name in CACHE_POLICY}
+
+metrics = Metrics()
+
+# Provider fetches run on their own threads so a slow API only delays its own pane
+provider_pool = ThreadPoolExecutor(max_workers=len(PROVIDER_DEADLINES), thread_name_prefix='provider')
+
+def measured(name, fetch):
     """
-    Runs todoist.py and returns a list of tasks.
+    Wraps a provider fetch to record its latency and errors.
+    """
+    def measured_fetch():
+        start = time.monotonic()
+        try:
+            result = fetch()
+        except Exception:
+            metrics.inc('provider_errors_total', provider=name)
+            raise
+        finally:
+            metrics.set('provider_fetch_seconds', time.monotonic() - start, provider=name)
+        metrics.inc('provider_fetches_total', provider=name)
+        return result
+    return measured_fetch
+
+def get_cached(name, fetch, ttl, max_stale, wait=0):
+    """
+    Returns the payload of provider name from the cache, fetching through its
+    circuit breaker. While the circuit is open, or when the fetch fails, cached
+    data is served whatever its age.
+    """
+    breaker = breakers[name]
+    if breaker.allow():
+        try:
+            return provider_cache.get(name, breaker.wrap(measured(name, fetch)), ttl, max_stale, wait=wait)
+        except Exception:
+            payload = provider_cache.peek(name)
+            if payload is None:
+                raise
+            logging.warning(f"Fetching {name} failed, serving cached data")
+            return payload
+
+    payload = provider_cache.peek(name)
+    if payload is None:
+        raise CircuitOpenError(f"{name} circuit open, nothing cached")
+    return payload
+
+def get_tasks(wait=0):
+    """
+    Returns the list of formatted tasks from todoist.py.
     """
     try:
-        process = subprocess.Popen(['python', 'todoist.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        if process.returncode == 0:
-            output = stdout.decode('utf-8')
-            # The script prints a JSON array at the end, find and parse it
-            json_start = output.find('[\n')
-            if json_start != -1:
-                json_str = output[json_start:]
-                return json.loads(json_str)
-        else:
-            logging.error("Error running todoist.py")
-            logging.error(stderr.decode('utf-8'))
-            return []
+        return get_cached('tasks', todoist.fetch_tasks, *CACHE_POLICY['tasks'], wait=wait)
+    except CircuitOpenError as e:
+        logging.debug(e)
+        return []
     except Exception as e:
         logging.error(f"Exception getting tasks: {e}")
         return []
-    return []
 
-def get_departures():
+def get_departures(wait=0):
     """
-    Runs departures.py and returns a list of departures.
+    Returns the departures from departures.py that have not left yet.
+    The fetched window is refetched early when few departures are left in it.
     """
     try:
-        process = subprocess.Popen(['python', 'departures.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        if process.returncode == 0:
-            output = stdout.decode('utf-8')
-            # The script prints a JSON array at the end, find and parse it
-            json_start = output.find('[{')
-            if json_start != -1:
-                json_str = output[json_start:]
-                return json.loads(json_str)
-        else:
-            logging.error("Error running departures.py")
-            logging.error(stderr.decode('utf-8'))
-            return []
+        fetch = departures.fetch_departures
+        ttl, max_stale = CACHE_POLICY['departures']
+        failures = breakers['departures'].failures
+        upcoming = departures.upcoming(get_cached('departures', fetch, ttl, max_stale, wait=wait))
+        # Refetching right after a failed fetch would only count a second failure
+        if len(upcoming) < departures.MIN_UPCOMING and breakers['departures'].failures <= failures:
+            upcoming = departures.upcoming(get_cached('departures', fetch, DEPARTURES_LOW_TTL, ttl + max_stale, wait=wait))
+        return upcoming
+    except CircuitOpenError as e:
+        logging.debug(e)
+        return []
     except Exception as e:
         logging.error(f"Exception getting departures: {e}")
         return []
-    return []
 
-def get_weather():
+def get_weather(wait=0):
     """
-    Runs weather.py and returns weather data.
+    Returns the weather data from weather.py.
     """
     try:
-        process = subprocess.Popen(['python', 'weather.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        if process.returncode == 0:
-            output = stdout.decode('utf-8')
-            # The script prints a JSON object at the end
-            json_start = output.find('{')
-            if json_start != -1:
-                json_str = output[json_start:]
-                return json.loads(json_str)
-        else:
-            logging.error("Error running weather.py")
-            logging.error(stderr.decode('utf-8'))
-            return None
+        return get_cached('weather', weather.fetch_weather, *CACHE_POLICY['weather'], wait=wait)
+    except CircuitOpenError as e:
+        logging.debug(e)
+        return None
     except Exception as e:
         logging.error(f"Exception getting weather: {e}")
         return None
-    return None
+
+def stale_providers():
+    """
+    Returns the names of the providers whose cached data is missing or older than its TTL.
+    """
+    stale = []
+    for name, (ttl, _) in CACHE_POLICY.items():
+        age = provider_cache.age(name)
+        if age is None or age >= ttl:
+            stale.append(name)
+    return stale
+
+def fetch_all(wait_for_refresh=True, names=None):
+    """
+    Starts all provider fetches, or those in names, concurrently and collects their results.
+    Stale cached data is refreshed until shortly before the provider's deadline,
+    or returned right away if wait_for_refresh is False.
+    A provider that misses its deadline gets the same fallback as a failed fetch.
+    """
+    providers = {
+        'weather': (get_weather, None),
+        'departures': (get_departures, []),
+        'tasks': (get_tasks, []),
+    }
+    if names is not None:
+        providers = {name: provider for name, provider in providers.items() if name in names}
+    started = time.monotonic()
+    futures = {}
+    for name, (fetch, _) in providers.items():
+        wait = max(PROVIDER_DEADLINES[name] - 1, 0) if wait_for_refresh else 0
+        futures[name] = provider_pool.submit(fetch, wait)
+
+    results = {}
+    for name, future in futures.items():
+        remaining = PROVIDER_DEADLINES[name] - (time.monotonic() - started)
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            logging.error(f"Fetching {name} missed its {PROVIDER_DEADLINES[name]}s deadline")
+            metrics.inc('provider_deadline_misses_total', provider=name)
+            results[name] = providers[name][1]
+    logging.debug(f"Fetched providers in {time.monotonic() - started:.2f}s")
+    for host, stats in sessions.connection_stats().items():
+        logging.debug(f"{host}: {stats['requests']} requests over {stats['connections']} connections ({stats['reused']} reused)")
+        metrics.set_total('http_requests_total', stats['requests'], host=host)
+        metrics.set_total('http_connections_total', stats['connections'], host=host)
+    return results
+
+def handle_command(request, scheduler, panes):
+    """
+    Carries out a command received on the control socket. Commands that change
+    what is shown make the affected providers due, so the main loop redraws
+    within seconds:
+
+    {"cmd": "refresh", "pane": "bus"}           redraw a pane (or "all") from its provider
+    {"cmd": "invalidate", "provider": "tasks"}  drop cached data and refetch it
+    {"cmd": "push", "provider": ..., "data": ...}  show data in place of a fetch
+    {"cmd": "status"}                           metrics, provider health and seconds until each job is due
+    """
+    cmd = request.get('cmd')
+    if cmd == 'refresh':
+        pane = request.get('pane', 'all')
+        names = list(PANE_PROVIDERS) if pane == 'all' else [pane]
+        if any(name not in PANE_PROVIDERS for name in names):
+            raise ValueError(f"Unknown pane {pane!r}")
+        for name in names:
+            panes.invalidate(name)
+        scheduler.trigger(*{PANE_PROVIDERS[name] for name in names})
+    elif cmd in ('invalidate', 'push'):
+        provider = request.get('provider')
+        if provider not in CACHE_POLICY:
+            raise ValueError(f"Unknown provider {provider!r}")
+        if cmd == 'push':
+            if 'data' not in request:
+                raise ValueError("push needs \"data\"")
+            # A payload the panes cannot draw would be cached and crash every render
+            PAYLOAD_VALIDATORS[provider](request['data'])
+            provider_cache.put(provider, request['data'])
+        else:
+            provider_cache.invalidate(provider)
+        scheduler.trigger(provider)
+    elif cmd == 'status':
+        return {'ok': True, 'stale': stale_providers(), 'due_in': scheduler.due_in(),
+                'health': {name: breaker.health() for name, breaker in breakers.items()},
+                'metrics': metrics.snapshot()}
+    else:
+        raise ValueError(f"Unknown command {cmd!r}")
+    logging.info(f"Control command: {cmd}")
+    return {'ok': True}
 
 def draw_weather(draw, x_offset, y_offset, width, height, font_large, font_medium, font_small, weather_data):
     """
     Draws the weather pane.
     """
-    draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=255)
+    draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=WHITE)
     
     # Show current date at the top
     from datetime import datetime
-    font_date = ImageFont.truetype(os.path.join(picdir, 'MapleMonoBold.ttf'), 27)  # 1.5x of font_small (18)
+    font_date = get_font(27)  # 1.5x of font_small (18)
     current_date = datetime.now().strftime("%d %b")
-    _, _, date_w, date_h = font_date.getbbox(current_date)
-    draw.text((x_offset + (width - date_w) / 2, y_offset + 10), current_date, font=font_date, fill=0)
+    _, _, date_w, date_h = bbox(font_date, current_date)
+    draw.text((x_offset + (width - date_w) / 2, y_offset + 10), current_date, font=font_date, fill=BLACK)
     
     # Get weather data or use placeholders
     if weather_data and 'now' in weather_data:
@@ -113,25 +293,25 @@ def draw_weather(draw, x_offset, y_offset, width, height, font_large, font_mediu
     location = "Berlin/Schöneberg"
 
     # Centered current weather (adjusted for date above)
-    _, _, w, h = font_large.getbbox(current_temp)
-    draw.text((x_offset + (width - w) / 2, y_offset + date_h + 20 + (height - date_h - 20 - h) / 2), current_temp, font=font_large, fill=0)
+    _, _, w, h = bbox(font_large, current_temp)
+    draw.text((x_offset + (width - w) / 2, y_offset + date_h + 20 + (height - date_h - 20 - h) / 2), current_temp, font=font_large, fill=BLACK)
 
     # Location
-    _, _, w_loc, h_loc = font_medium.getbbox(location)
-    draw.text((x_offset + (width - w_loc) / 2, y_offset + date_h + 20 + (height - date_h - 20 - h) / 2 + h + 10), location, font=font_medium, fill=0)
+    _, _, w_loc, h_loc = bbox(font_medium, location)
+    draw.text((x_offset + (width - w_loc) / 2, y_offset + date_h + 20 + (height - date_h - 20 - h) / 2 + h + 10), location, font=font_medium, fill=BLACK)
 
     # Min and Max weather
-    _, _, w_min, h_min = font_medium.getbbox(min_temp)
-    draw.text((x_offset + 10, y_offset + date_h + 20 + (height - date_h - 20 - h_min) / 2), min_temp, font=font_medium, fill=0)
+    _, _, w_min, h_min = bbox(font_medium, min_temp)
+    draw.text((x_offset + 10, y_offset + date_h + 20 + (height - date_h - 20 - h_min) / 2), min_temp, font=font_medium, fill=BLACK)
 
-    _, _, w_max, h_max = font_medium.getbbox(max_temp)
-    draw.text((x_offset + width - w_max - 10, y_offset + date_h + 20 + (height - date_h - 20 - h_max) / 2), max_temp, font=font_medium, fill=0)
+    _, _, w_max, h_max = bbox(font_medium, max_temp)
+    draw.text((x_offset + width - w_max - 10, y_offset + date_h + 20 + (height - date_h - 20 - h_max) / 2), max_temp, font=font_medium, fill=BLACK)
 
 def draw_forecast(draw, x_offset, y_offset, width, height, font_small, weather_data):
     """
     Draws the 5-day weather forecast.
     """
-    draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=255)
+    draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=WHITE)
     
     y_pos = y_offset + 30  # Add padding at top
     
@@ -147,10 +327,10 @@ def draw_forecast(draw, x_offset, y_offset, width, height, font_small, weather_d
         today_min = weather_data['now']['min']
         today_max = weather_data['now']['max']
         
-        draw.text((left_margin, y_pos), "Today:", font=font_small, fill=0)
-        draw.text((min_col_x, y_pos), f"{today_min}°", font=font_small, fill=0)
-        draw.text((max_col_x, y_pos), f"{today_max}°", font=font_small, fill=0)
-        _, _, _, line_h = font_small.getbbox("Today:")
+        draw.text((left_margin, y_pos), "Today:", font=font_small, fill=BLACK)
+        draw.text((min_col_x, y_pos), f"{today_min}°", font=font_small, fill=BLACK)
+        draw.text((max_col_x, y_pos), f"{today_max}°", font=font_small, fill=BLACK)
+        _, _, _, line_h = bbox(font_small, "Today:")
         y_pos += line_h + 8
         
         # Then show next days with weekday abbreviations
@@ -160,32 +340,40 @@ def draw_forecast(draw, x_offset, y_offset, width, height, font_small, weather_d
                 date_obj = datetime.fromisoformat(day['date'])
                 weekday = date_obj.strftime("%a")
                 
-                draw.text((left_margin, y_pos), f"{weekday}:", font=font_small, fill=0)
-                draw.text((min_col_x, y_pos), f"{day['min']}°", font=font_small, fill=0)
-                draw.text((max_col_x, y_pos), f"{day['max']}°", font=font_small, fill=0)
-                _, _, _, line_h = font_small.getbbox(weekday)
+                draw.text((left_margin, y_pos), f"{weekday}:", font=font_small, fill=BLACK)
+                draw.text((min_col_x, y_pos), f"{day['min']}°", font=font_small, fill=BLACK)
+                draw.text((max_col_x, y_pos), f"{day['max']}°", font=font_small, fill=BLACK)
+                _, _, _, line_h = bbox(font_small, weekday)
                 y_pos += line_h + 8
                 
                 if y_pos > y_offset + height - 20:
                     break
     else:
         forecast_line = "No forecast data"
-        _, _, line_w, _ = font_small.getbbox(forecast_line)
-        draw.text((x_offset + (width - line_w) / 2, y_pos), forecast_line, font=font_small, fill=0)
+        _, _, line_w, _ = bbox(font_small, forecast_line)
+        draw.text((x_offset + (width - line_w) / 2, y_pos), forecast_line, font=font_small, fill=BLACK)
+
+def departure_label(dep):
+    """
+    Returns the departure time with the minutes left until it, e.g. "08:12 (5')".
+    """
+    if 'minutes' not in dep:
+        return dep['time']
+    if dep['minutes'] == 0:
+        return f"{dep['time']} (now)"
+    return f"{dep['time']} ({dep['minutes']}')"
 
-def draw_bus_departures(draw, x_offset, width, height, font_medium, font_small):
+def draw_bus_departures(draw, x_offset, width, height, font_medium, font_small, departures_data):
     """
     Draws the bus departure times pane.
     """
-    draw.rectangle([(x_offset, 0), (x_offset + width, height)], fill=255)
+    draw.rectangle([(x_offset, 0), (x_offset + width, height)], fill=WHITE)
     
     title = "Bus 106 Departures \uf207"
-    _, _, w, h = font_medium.getbbox(title)
-    draw.text((x_offset + (width - w) / 2, 10), title, font=font_medium, fill=0)
+    _, _, w, h = bbox(font_medium, title)
+    draw.text((x_offset + (width - w) / 2, 10), title, font=font_medium, fill=BLACK)
 
-    # Fetch actual departure times
-    departures_data = get_departures()
-    departures = [(dep['time'], dep['direction']) for dep in departures_data[:3]]  # Take first 3
+    departures = [(departure_label(dep), dep['direction']) for dep in departures_data[:3]]  # Take first 3
     
     if not departures:
         departures = [("--:--", "No data")] * 3  # Fallback if no data
@@ -200,150 +388,244 @@ def draw_bus_departures(draw, x_offset, width, height, font_medium, font_small):
         section_center = x_offset + (i + 0.5) * section_width
         
         # Draw time centered in section
-        _, _, time_w, time_h = font_small.getbbox(time)
+        _, _, time_w, time_h = bbox(font_small, time)
         x_pos_time = section_center - time_w / 2
-        draw.text((x_pos_time, y_pos), time, font=font_small, fill=0)
+        draw.text((x_pos_time, y_pos), time, font=font_small, fill=BLACK)
         
         # Draw direction below time, also centered
-        _, _, dir_w, _ = font_small.getbbox(direction)
+        _, _, dir_w, _ = bbox(font_small, direction)
         x_pos_dir = section_center - dir_w / 2
-        draw.text((x_pos_dir, y_pos + time_h + 5), direction, font=font_small, fill=0)
+        draw.text((x_pos_dir, y_pos + time_h + 5), direction, font=font_small, fill=BLACK)
 
-def draw_tasks(draw_bw, draw_red, x_offset, y_offset, width, height, font_medium, font_small):
+def draw_tasks(draw, x_offset, y_offset, width, height, font_medium, font_small, tasks):
     """
     Draws the tasks pane.
     """
-    draw_bw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=255)
+    draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)], fill=WHITE)
     
     title = "Lily's Tasks \uf0ae"
-    _, _, w, h = font_medium.getbbox(title)
-    draw_bw.text((x_offset + (width - w) / 2, y_offset + 10), title, font=font_medium, fill=0)
+    _, _, w, h = bbox(font_medium, title)
+    draw.text((x_offset + (width - w) / 2, y_offset + 10), title, font=font_medium, fill=BLACK)
 
-    tasks = get_tasks()
     y_pos = y_offset + 10 + h + 10
     max_width = width - 40  # Leave margin on right side
     
     if tasks:
         for task in tasks:
-            # Parse task to find text in parentheses
-            parts = re.split(r'(\([^)]*\))', task)
-            
-            x_pos = x_offset + 20
-            line_start_x = x_offset + 20
-            draw_bw.text((x_pos, y_pos), "- ", font=font_small, fill=0)
-            _, _, dash_w, dash_h = font_small.getbbox("- ")
-            x_pos += dash_w
-            line_start_x = x_pos  # Start of actual text after dash
-            
-            max_line_height = dash_h
-            for part in parts:
-                if not part:  # Skip empty strings
-                    continue
-                
-                # Split part into words for better wrapping
-                words = part.split(' ')
-                for word_idx, word in enumerate(words):
-                    if word_idx > 0:
-                        word = ' ' + word  # Add space back except for first word
-                    
-                    _, _, word_w, word_h = font_small.getbbox(word)
-                    
-                    # Check if word fits on current line
-                    if x_pos + word_w > x_offset + max_width and x_pos > line_start_x:
-                        # Move to next line
-                        y_pos += max_line_height + 3
-                        x_pos = line_start_x
-                        max_line_height = 0
-                        
-                        # Remove leading space if word starts with space
-                        if word.startswith(' '):
-                            word = word[1:]
-                            _, _, word_w, word_h = font_small.getbbox(word)
-                    
-                    # Draw the word
-                    if part.startswith('(') and part.endswith(')'):
-                        # Draw parentheses text in red
-                        draw_red.text((x_pos, y_pos), word, font=font_small, fill=0)
-                    else:
-                        # Draw regular text in black
-                        draw_bw.text((x_pos, y_pos), word, font=font_small, fill=0)
-                    
-                    x_pos += word_w
-                    max_line_height = max(max_line_height, word_h)
-            
-            y_pos += max_line_height + 5
+            # Layouts are relative to the bullet, which sits 20 px into the pane
+            lines = layout_task(task, font_small, max_width - 20)
+            for line_idx, (runs, line_height) in enumerate(lines):
+                if line_idx > 0:
+                    y_pos += lines[line_idx - 1][1] + 3
+                for x, text, red in runs:
+                    # Parenthesized runs are drawn in red, everything else in black
+                    draw.text((x_offset + 20 + x, y_pos), text, font=font_small, fill=RED if red else BLACK)
+
+            y_pos += lines[-1][1] + 5
             if y_pos > y_offset + height - 20: # Don't draw off screen
                 break
     else:
-        draw_bw.text((x_offset + 20, y_pos), "No tasks today!", font=font_small, fill=0)
+        draw.text((x_offset + 20, y_pos), "No tasks today!", font=font_small, fill=BLACK)
 
 
-def main():
+@contextmanager
+def timed(timings, name):
+    """
+    Records the duration of the block in timings[name], if timings is not None.
+    """
+    start = time.perf_counter()
     try:
-        logging.info("Home Dashboard")
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = time.perf_counter() - start
 
-        epd = epd7in5b_V2.EPD()
-        logging.info("init and Clear")
-        epd.init()
-        epd.Clear()
-        logging.info("done with Clear")
+def render_frame(epd, fonts, data, timings=None, panes=None):
+    """
+    Renders all panes into one palette image, drawn with WHITE, BLACK and RED.
+    Panes whose data did not change since the last frame are taken from panes,
+    a PaneCompositor; without one every pane is drawn from scratch.
+    Per-pane render durations are recorded in timings, if given.
+    """
+    font_large, font_medium, font_small = fonts
+    if panes is None:
+        panes = PaneCompositor((epd.width, epd.height))
 
-        font_large = ImageFont.truetype(os.path.join(picdir, 'MapleMonoBold.ttf'), 48)
-        font_medium = ImageFont.truetype(os.path.join(picdir, 'MapleMonoBold.ttf'), 24)
-        font_small = ImageFont.truetype(os.path.join(picdir, 'MapleMonoBold.ttf'), 18)
+    # Screen dimensions
+    screen_width = epd.width
+    screen_height = epd.height
 
-        while True:
-            # Create a new image for the display
-            Himage = Image.new('1', (epd.width, epd.height), 255)  # Black and white
-            Other = Image.new('1', (epd.width, epd.height), 255)   # Red
-            draw_bw = ImageDraw.Draw(Himage)
-            draw_red = ImageDraw.Draw(Other)
+    # Vertical split
+    left_pane_width = screen_width // 2
+
+    # Left pane horizontal split
+    weather_pane_height = int(screen_height * 0.40)
+
+    # Right pane horizontal split
+    bus_pane_height = int(screen_height * 0.25)
+
+    weather_data = data['weather']
+
+    # Draw Weather (top-left pane)
+    with timed(timings, 'weather'):
+        panes.pane('weather', (0, 0, left_pane_width, weather_pane_height), weather_data,
+                   lambda draw, w, h: draw_weather(draw, 0, 0, w, h, font_large, font_medium, font_small, weather_data))
 
-            # Screen dimensions
-            screen_width = epd.width
-            screen_height = epd.height
+    # Draw Forecast (bottom-left pane)
+    with timed(timings, 'forecast'):
+        panes.pane('forecast', (0, weather_pane_height, left_pane_width, screen_height), weather_data,
+                   lambda draw, w, h: draw_forecast(draw, 0, 0, w, h, font_small, weather_data))
 
-            # Vertical split
-            left_pane_width = screen_width // 2
-            right_pane_width = screen_width // 2
+    # Draw Bus Departures (top-right pane)
+    with timed(timings, 'bus'):
+        panes.pane('bus', (left_pane_width, 0, screen_width, bus_pane_height), data['departures'],
+                   lambda draw, w, h: draw_bus_departures(draw, 0, w, h, font_medium, font_small, data['departures']))
 
-            # Left pane horizontal split
-            weather_pane_height = int(screen_height * 0.40)
-            forecast_pane_height = screen_height - weather_pane_height
-            
-            # Right pane horizontal split
-            bus_pane_height = int(screen_height * 0.25)
-            tasks_pane_height = screen_height - bus_pane_height
+    # Draw Tasks (bottom-right pane)
+    with timed(timings, 'tasks'):
+        panes.pane('tasks', (left_pane_width, bus_pane_height, screen_width, screen_height), data['tasks'],
+                   lambda draw, w, h: draw_tasks(draw, 0, 0, w, h, font_medium, font_small, data['tasks']))
 
-            # Fetch weather data
-            weather_data = get_weather()
+    # Draw vertical separator line, over the edges of the panes it separates
+    ImageDraw.Draw(panes.image).line((left_pane_width, 0, left_pane_width, screen_height), fill=BLACK, width=2)
 
-            # Draw Weather (top-left pane)
-            draw_weather(draw_bw, 0, 0, left_pane_width, weather_pane_height, font_large, font_medium, font_small, weather_data)
+    return panes.image
 
-            # Draw Forecast (bottom-left pane)
-            draw_forecast(draw_bw, 0, weather_pane_height, left_pane_width, forecast_pane_height, font_small, weather_data)
+def push_frame(epd, compositor, image, allow_partial=True):
+    """
+    Pushes the rendered image through the compositor. A panel that hangs while
+    busy has already been reset by the driver; re-initialise it so the next
+    push does a full refresh.
+    """
+    try:
+        return compositor.push(*epd.getbuffers_tricolor(image), allow_partial=allow_partial)
+    except TimeoutError as e:
+        logging.error(f"Display refresh failed: {e}")
+        epd.init()
+        compositor.reset()
+        return 'error'
 
-            # Draw Bus Departures (top-right pane)
-            draw_bus_departures(draw_bw, left_pane_width, right_pane_width, bus_pane_height, font_medium, font_small)
+def update_display(epd, compositor, panes, fonts, data, cycle_start, allow_partial=True):
+    """
+    Renders data, pushes it to the panel and publishes the metrics of the cycle
+    that started at cycle_start (time.monotonic()).
+    """
+    timings = {}
+    with timed(timings, 'render'):
+        image = render_frame(epd, fonts, data, timings, panes)
+    busy_before = epd.total_busy_time
+    result = push_frame(epd, compositor, image, allow_partial)
+
+    for pane in ('weather', 'forecast', 'bus', 'tasks'):
+        metrics.set('render_seconds', timings[pane], pane=pane)
+        metrics.set_total('pane_cache_hits_total', panes.hits.get(pane, 0), pane=pane)
+        metrics.set_total('pane_cache_misses_total', panes.misses.get(pane, 0), pane=pane)
+    for name, breaker in breakers.items():
+        metrics.set('provider_circuit_open', int(breaker.state == 'open'), provider=name)
+        metrics.set('provider_consecutive_failures', breaker.failures, provider=name)
+    metrics.set('cycle_duration_seconds', time.monotonic() - cycle_start)
+    metrics.set('last_cycle_timestamp_seconds', time.time())
+    metrics.inc('cycles_total')
+    metrics.inc('display_updates_total', result=result)
+    # Busy time of this push only; 0 when nothing was refreshed
+    metrics.set('busy_wait_seconds', epd.total_busy_time - busy_before)
+    metrics.set_total('busy_wait_seconds_total', epd.total_busy_time)
+    metrics.set_total('spi_bytes_total', epd.bytes_sent)
+    # Unchanged frames are mostly skipped by the compositor, before the driver's digest check
+    metrics.inc('refreshes_skipped_total', int(result == 'skip'))
+    bbox_stats = bbox_cache_stats()
+    metrics.set_total('text_bbox_cache_hits_total', bbox_stats['hits'])
+    metrics.set_total('text_bbox_cache_misses_total', bbox_stats['misses'])
+    metrics.set('text_bbox_cache_hit_ratio', bbox_stats['hit_rate'])
+    layout_stats = layout_cache_stats()
+    metrics.set_total('task_layout_cache_hits_total', layout_stats['hits'])
+    metrics.set_total('task_layout_cache_misses_total', layout_stats['misses'])
+    metrics.write()
+    return result
 
-            # Draw Tasks (bottom-right pane)
-            draw_tasks(draw_bw, draw_red, left_pane_width, bus_pane_height, right_pane_width, tasks_pane_height, font_medium, font_small)
+def main():
+    try:
+        logging.info("Home Dashboard")
 
-            # Draw vertical separator line
-            draw_bw.line((left_pane_width, 0, left_pane_width, screen_height), fill=0, width=2)
+        epd = epd7in5b_V2.EPD()
+        if DISPLAY == 'framebuffer':
+            # displayd.py owns the panel; frames go through the shared framebuffer,
+            # where other processes can draw over them
+            logging.info("Writing frames to the shared framebuffer")
+            compositor = FrameBufferWriter(FrameBuffer(width=epd.width, height=epd.height))
+        else:
+            epd.init()
+            # After a restart the panel still shows the last frame; clearing it is only
+            # needed when that frame is unknown, and an unchanged frame is not redrawn
+            compositor = FrameCompositor(epd)
+            restored = epd.restore_state()
+            if restored:
+                logging.info("Restored panel state, skipping Clear")
+                # Lets the first frame be a partial refresh of what changed since the restart
+                compositor.black, compositor.red = restored
+            else:
+                logging.info("Clear")
+                epd.Clear()
+                logging.info("done with Clear")
+
+        # Large, medium and small; 27 is the date in the weather pane
+        fonts = preload(48, 24, 18)
+        preload(27)
+
+        panes = PaneCompositor((epd.width, epd.height))
+
+        # Each provider is refetched on its own interval; updates falling due together
+        # are fetched concurrently and shown with one refresh
+        scheduler = Scheduler()
+        for name, (interval, priority, full_refresh) in SCHEDULE.items():
+            scheduler.add(name, interval, priority, full_refresh)
+
+        # External triggers, e.g. a completed task, redraw right away instead of on the next interval
+        ControlServer(lambda request: handle_command(request, scheduler, panes)).start()
+
+        # The first frame after boot is rendered from cache without waiting on the network
+        first_cycle = True
+        data = {}
 
-            epd.display(epd.getbuffer(Himage), epd.getbuffer(Other))
-            
-            logging.info("Sleeping for 30 minutes...")
-            time.sleep(30 * 60)
+        while True:
+            batch = scheduler.wait()
+            cycle_start = time.monotonic()
+
+            # Fetch the due providers concurrently
+            fetched = fetch_all(wait_for_refresh=not first_cycle, names=[job.name for job in batch])
+            changed = [job for job in batch if job.name not in data or fetched[job.name] != data[job.name]]
+            data.update(fetched)
+
+            # Checked before the push, which can take longer than the background
+            # refreshes fetch_all() started; once they finish every entry looks fresh
+            stale = stale_providers() if first_cycle else []
+
+            # Unless the data of a job asking for a full refresh changed, the compositor
+            # pushes the changed regions with a partial refresh
+            update_display(epd, compositor, panes, fonts, data, cycle_start,
+                           allow_partial=not any(job.full_refresh for job in changed))
+
+            first_cycle = False
+            if stale:
+                logging.info(f"Rendered cached {', '.join(stale)}, redrawing with live data")
+                scheduler.trigger(*stale)
+
+    except TimeoutError as e:
+        # Raised by ReadBusy() when re-initialising a hung panel failed as well; exit
+        # non-zero so the service manager restarts the dashboard
+        logging.error(f"e-Paper not responding, exiting: {e}")
+        if DISPLAY != 'framebuffer':
+            epd7in5b_V2.epdconfig.module_exit(cleanup=True)
+        sys.exit(1)
 
     except IOError as e:
         logging.info(e)
     
     except KeyboardInterrupt:    
         logging.info("ctrl + c:")
-        epd7in5b_V2.epdconfig.module_exit(cleanup=True)
+        if DISPLAY != 'framebuffer':
+            epd.flush_state()
+            epd7in5b_V2.epdconfig.module_exit(cleanup=True)
         exit()
 
 if __name__ == '__main__':
@@ -1,44 +1,115 @@
-import requests
-from datetime import datetime
+import json
+from datetime import datetime, timezone
+
+from sessions import get_session
 
 BASE = "https://v6.bvg.transport.rest"
 STOP_ID = "900058105"  # Lindenhof
 LINE_NAME = "106"
-DURATION_MIN = 50
-
-resp = requests.get(
-    f"{BASE}/stops/{STOP_ID}/departures",
-    params={"duration": DURATION_MIN},
-    timeout=10
-)
-resp.raise_for_status()
-
-departures = resp.json().get("departures", [])
-
-results = []
-for dep in departures:
-    if dep.get("line", {}).get("name") != LINE_NAME:
-        continue
-
-    when = dep.get("when") or dep.get("plannedWhen")
-    direction = dep.get("direction", "Unknown")
-    delay = dep.get("delay", 0)
-
-    if when:
-        t = datetime.fromisoformat(when.replace("Z", "+00:00"))
-        results.append({
-            "time": t.strftime("%H:%M"),
-            "direction": direction,
-            "delay_min": delay // 60 if delay else 0
-        })
-
-print("Bus 106 @ Lindenhof:")
-for r in results[:4]:
-    delay = f" (+{r['delay_min']} min)" if r["delay_min"] else ""
-    print(f"- {r['time']} → {r['direction']}{delay}")
-
-# Return as JSON array sorted by departure time
-import json
-output = [{"time": r["time"], "direction": r["direction"]} for r in results[:3]]
-print("\nDepartures as JSON array:")
-print(json.dumps(output, ensure_ascii=False))
+DURATION_MIN = 60
+
+# Departures of all bus lines at the stop requested per fetch; LINE_NAME is picked out of these
+RESULTS = 20
+
+# The window is refetched early once fewer departures than this are left in it
+MIN_UPCOMING = 3
+
+# Only buses are requested, and no remarks or lines of the stop
+QUERY = {
+    "duration": DURATION_MIN,
+    "results": RESULTS,
+    "bus": "true",
+    "suburban": "false",
+    "subway": "false",
+    "tram": "false",
+    "ferry": "false",
+    "express": "false",
+    "regional": "false",
+    "remarks": "false",
+    "linesOfStops": "false",
+}
+
+
+def fetch_departures():
+    """
+    Fetches upcoming departures of LINE_NAME at STOP_ID, sorted by departure time.
+    """
+    resp = get_session(BASE).get(
+        f"{BASE}/stops/{STOP_ID}/departures",
+        params=QUERY,
+        timeout=10
+    )
+    resp.raise_for_status()
+
+    departures = resp.json().get("departures", [])
+
+    results = []
+    for dep in departures:
+        if dep.get("line", {}).get("name") != LINE_NAME:
+            continue
+
+        when = dep.get("when") or dep.get("plannedWhen")
+        direction = dep.get("direction", "Unknown")
+        delay = dep.get("delay", 0)
+
+        if when:
+            t = datetime.fromisoformat(when.replace("Z", "+00:00"))
+            results.append({
+                "time": t.strftime("%H:%M"),
+                "when": t.isoformat(),
+                "direction": direction,
+                "delay_min": delay // 60 if delay else 0
+            })
+
+    return results
+
+
+def upcoming(window, now=None):
+    """
+    Returns the departures of a fetched window that have not left yet, with the
+    whole minutes until departure in "minutes". Entries without a departure
+    timestamp are passed through.
+    """
+    now = now or datetime.now(timezone.utc)
+    results = []
+    for dep in window:
+        if "when" not in dep:
+            results.append(dep)
+            continue
+        seconds = (datetime.fromisoformat(dep["when"]) - now).total_seconds()
+        if seconds < 0:
+            continue
+        results.append(dict(dep, minutes=int(seconds // 60)))
+    return results
+
+
+def validate(payload):
+    """
+    Raises ValueError unless payload has the shape fetch_departures() returns.
+    """
+    if not isinstance(payload, list):
+        raise ValueError("departures payload must be a list")
+    for dep in payload:
+        if not isinstance(dep, dict) or not isinstance(dep.get("time"), str) or not isinstance(dep.get("direction"), str):
+            raise ValueError("departures need string \"time\" and \"direction\"")
+        if "when" in dep:
+            try:
+                when = datetime.fromisoformat(dep["when"])
+            except (TypeError, ValueError):
+                raise ValueError(f"departure \"when\" {dep['when']!r} is not an ISO timestamp")
+            if when.tzinfo is None:
+                raise ValueError(f"departure \"when\" {dep['when']!r} has no UTC offset")
+
+
+if __name__ == "__main__":
+    results = fetch_departures()
+
+    print("Bus 106 @ Lindenhof:")
+    for r in results[:4]:
+        delay = f" (+{r['delay_min']} min)" if r["delay_min"] else ""
+        print(f"- {r['time']} → {r['direction']}{delay}")
+
+    # Return as JSON array sorted by departure time
+    output = [{"time": r["time"], "direction": r["direction"]} for r in upcoming(results)[:3]]
+    print("\nDepartures as JSON array:")
+    print(json.dumps(output, ensure_ascii=False))
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Display daemon: owns the panel and shows whatever local processes commit to the
+# shared framebuffer (framebuffer.py). Commits made while a refresh is running are
+# shown together with the next one.
+import sys
+import os
+import logging
+import time
+
+libdir = os.path.dirname(os.path.realpath(__file__))
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+import epd7in5b_V2
+from compositor import FrameCompositor
+from framebuffer import FrameBuffer
+
+logging.basicConfig(level=logging.DEBUG)
+
+# Seconds between checks of the framebuffer's sequence number
+POLL_INTERVAL = 0.1
+
+
+def main():
+    try:
+        logging.info("Display daemon")
+
+        epd = epd7in5b_V2.EPD()
+        epd.init()
+        fb = FrameBuffer(width=epd.width, height=epd.height)
+
+        # Start from what the panel shows, so writers draw over the current frame
+        restored = epd.restore_state()
+        if restored:
+            logging.info("Restored panel state, skipping Clear")
+            with fb.lock():
+                fb.write_region(0, 0, epd.width, *restored)
+                fb.commit()
+        else:
+            epd.Clear()
+
+        compositor = FrameCompositor(epd)
+        if restored:
+            # Lets the first commit be a partial refresh of what changed since the restart
+            compositor.black, compositor.red = restored
+        shown = None
+
+        while True:
+            # Without new commits the frame is still pushed when a full refresh is due
+            if fb.seq == shown and not compositor.full_refresh_due():
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            shown, black, red = fb.snapshot()
+            try:
+                result = compositor.push(black, red)
+            except TimeoutError as e:
+                logging.error(f"Display refresh failed: {e}")
+                epd.init()
+                compositor.reset()
+                shown = None
+                continue
+            logging.info(f"Showed commit {shown}: {result}")
+
+    except TimeoutError as e:
+        # Raised by ReadBusy() when re-initialising a hung panel failed as well; exit
+        # non-zero so the service manager restarts the daemon
+        logging.error(f"e-Paper not responding, exiting: {e}")
+        epd7in5b_V2.epdconfig.module_exit(cleanup=True)
+        sys.exit(1)
+
+    except IOError as e:
+        logging.info(e)
+
+    except KeyboardInterrupt:
+        logging.info("ctrl + c:")
+        epd.flush_state()
+        epd7in5b_V2.epdconfig.module_exit(cleanup=True)
+        exit()
+
+if __name__ == '__main__':
+    main()
@@ -28,8 +28,13 @@
 #
 
 
+import hashlib
 import logging
+import os
+import struct
+import time
 import epdconfig
+from epdconfig import INVERT
 
 # Display resolution
 EPD_WIDTH       = 800
@@ -37,6 +42,39 @@ EPD_HEIGHT      = 480
 
 logger = logging.getLogger(__name__)
 
+# Refresh at least this often (seconds), even if the frame did not change, to keep ghosting in check
+FULL_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Seconds to wait for the panel to release BUSY before giving up and resetting it
+BUSY_TIMEOUT = 60
+
+# While waiting, the status command 0x71 is repeated at this interval (seconds)
+BUSY_POLL_INTERVAL = 1
+
+# The planes last shown by the panel are kept here, so a restart can tell whether the
+# panel already shows the frame it is about to draw. Set to an empty string to disable.
+STATE_FILE = os.getenv("EPD_STATE_FILE", os.path.join(
+    os.getenv("XDG_STATE_HOME", os.path.join(os.path.expanduser("~"), ".local", "state")), "e-ink", "panel.state"))
+
+# After partial refreshes the state file is rewritten at most this often (seconds), to
+# spare the SD card; until then it stays removed and a restart clears the panel
+STATE_SAVE_INTERVAL = 60 * 60
+
+# State file header: magic, digest of the planes and wall-clock time of the last full refresh
+_STATE_HEADER = struct.Struct("<4s16sd")
+_STATE_MAGIC = b"EPD1"
+
+# Palette indices of tri-colour 'P' images, see getbuffers_tricolor()
+WHITE = 0
+BLACK = 1
+RED = 2
+PALETTE = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+
+# Image.point() tables mapping palette indices to plane bits: the black plane keeps
+# 0=black like PIL, the red plane has 1=red, so neither needs inverting
+_BLACK_LUT = [0 if i == BLACK else 255 for i in range(256)]
+_RED_LUT = [255 if i == RED else 0 for i in range(256)]
+
 class EPD:
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
@@ -46,6 +84,19 @@ class EPD:
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
         self.partFlag=1
+        self.full_refresh_interval = FULL_REFRESH_INTERVAL
+        self.last_digest = None      # digest of the planes currently shown by the panel
+        self.last_full_refresh = None
+        self.skipped_refreshes = 0
+        self.busy_timeout = BUSY_TIMEOUT
+        self.last_busy_time = 0.0    # seconds spent in the last ReadBusy()
+        self.total_busy_time = 0.0
+        self.bytes_sent = 0          # command and data bytes written over SPI
+        self.state_file = STATE_FILE
+        self._state_valid = True     # a state file may exist and must be invalidated before drawing
+        self.state_save_interval = STATE_SAVE_INTERVAL
+        self._last_state_save = None
+        self._pending_state = None   # planes shown since the state file was last written
 
     # Hardware reset
     def reset(self):
@@ -57,32 +108,52 @@ class EPD:
         epdconfig.delay_ms(200)   
 
     def send_command(self, command):
+        self.bytes_sent += 1
         epdconfig.digital_write(self.dc_pin, 0)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([command])
         epdconfig.digital_write(self.cs_pin, 1)
 
     def send_data(self, data):
+        self.bytes_sent += 1
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
     
     def send_data2(self, data): #faster
+        self.bytes_sent += len(data)
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
-    def ReadBusy(self):
+    def send_command_with_data(self, command, data):
+        # Sends a command followed by all of its parameters in one SPI transfer
+        self.send_command(command)
+        self.send_data2(data)
+
+    def ReadBusy(self, timeout=None):
+        # Waits for the BUSY edge instead of spinning on the pin. Returns the seconds
+        # spent waiting; on timeout the panel is reset and TimeoutError is raised.
+        if timeout is None:
+            timeout = self.busy_timeout
         logger.debug("e-Paper busy")
+        start = time.monotonic()
+        deadline = start + timeout
         self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 0):
+        while not epdconfig.wait_busy_release(min(BUSY_POLL_INTERVAL, max(deadline - time.monotonic(), 0))):
+            if time.monotonic() >= deadline:
+                logger.error(f"e-Paper still busy after {timeout}s, resetting")
+                self.reset()
+                raise TimeoutError(f"e-Paper busy for more than {timeout}s")
             self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
+        elapsed = time.monotonic() - start
+        self.last_busy_time = elapsed
+        self.total_busy_time += elapsed
         epdconfig.delay_ms(200)
-        logger.debug("e-Paper busy release")
+        logger.debug(f"e-Paper busy release after {elapsed:.2f}s")
+        return elapsed
         
     def init(self):
         if (epdconfig.module_init() != 0):
@@ -91,40 +162,18 @@ class EPD:
         # EPD hardware init start
         self.reset()
 
-        self.send_command(0x01)
-        self.send_data(0x07)
-        self.send_data(0x07)
-        self.send_data(0x3f)
-        self.send_data(0x3f)
-
-        self.send_command(0x06)
-        self.send_data(0x17)
-        self.send_data(0x17) 
-        self.send_data(0x28)	
-        self.send_data(0x17)
+        self.send_command_with_data(0x01, [0x07, 0x07, 0x3f, 0x3f])
+        self.send_command_with_data(0x06, [0x17, 0x17, 0x28, 0x17])
 
         self.send_command(0x04)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-        self.send_command(0X00)
-        self.send_data(0x0F)
-
-        self.send_command(0x61)		
-        self.send_data(0x03)
-        self.send_data(0x20)
-        self.send_data(0x01)
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        self.send_command(0X50)
-        self.send_data(0x11)
-        self.send_data(0x07)
-
-        self.send_command(0X60)
-        self.send_data(0x22)
+        self.send_command_with_data(0X00, [0x0F])
+        self.send_command_with_data(0x61, [0x03, 0x20, 0x01, 0xE0])
+        self.send_command_with_data(0X15, [0x00])
+        self.send_command_with_data(0X50, [0x11, 0x07])
+        self.send_command_with_data(0X60, [0x22])
             
         return 0
     
@@ -135,27 +184,16 @@ class EPD:
         # EPD hardware init start
         self.reset()
 
-        self.send_command(0X00)
-        self.send_data(0x0F)
+        self.send_command_with_data(0X00, [0x0F])
 
         self.send_command(0x04)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-        self.send_command(0x06)
-        self.send_data(0x27)
-        self.send_data(0x27) 
-        self.send_data(0x18)		
-        self.send_data(0x17)		
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5A)
-
-        self.send_command(0X50)
-        self.send_data(0x11)
-        self.send_data(0x07)
+        self.send_command_with_data(0x06, [0x27, 0x27, 0x18, 0x17])
+        self.send_command_with_data(0xE0, [0x02])
+        self.send_command_with_data(0xE5, [0x5A])
+        self.send_command_with_data(0X50, [0x11, 0x07])
         
         return 0
     
@@ -165,74 +203,176 @@ class EPD:
         # EPD hardware init start
         self.reset()
 
-        self.send_command(0X00)
-        self.send_data(0x1F)
+        self.send_command_with_data(0X00, [0x1F])
 
         self.send_command(0x04)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x6E)
-
-        self.send_command(0X50)
-        self.send_data(0xA9)
-        self.send_data(0x07)
+        self.send_command_with_data(0xE0, [0x02])
+        self.send_command_with_data(0xE5, [0x6E])
+        self.send_command_with_data(0X50, [0xA9, 0x07])
 
         # EPD hardware init end
         return 0
 
-    def getbuffer(self, image):
+    def _convert(self, image):
         img = image
         imwidth, imheight = img.size
         if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
+            return img if img.mode == '1' else img.convert('1')
         elif(imwidth == self.height and imheight == self.width):
             # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
-        else:
-            logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
+            return img.rotate(90, expand=True).convert('1')
+        logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
+        return None
+
+    def getbuffer(self, image):
+        img = self._convert(image)
+        if img is None:
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            return bytes(self.width // 8 * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
         # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        return img.tobytes('raw').translate(INVERT)
+
+    def getbuffers(self, imageblack, imagered):
+        # Returns the black and red planes ready to be sent to the panel. The black
+        # plane (0x10) uses 0=black like PIL and is sent as is, only the red plane
+        # (0x13) uses 1=red and needs to be inverted.
+        black = self._convert(imageblack)
+        red = self._convert(imagered)
+        if black is None or red is None:
+            size = self.width // 8 * self.height
+            return b'\xff' * size, bytes(size)
+        return black.tobytes('raw'), red.tobytes('raw').translate(INVERT)
+
+    def getbuffers_tricolor(self, image):
+        # Splits a 'P' image drawn with the WHITE, BLACK and RED palette indices into
+        # the black and red planes, as getbuffers() returns them
+        imwidth, imheight = image.size
+        if(imwidth == self.height and imheight == self.width):
+            image = image.rotate(90, expand=True)
+        elif(imwidth != self.width or imheight != self.height):
+            logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
+            size = self.width // 8 * self.height
+            return b'\xff' * size, bytes(size)
+        return image.point(_BLACK_LUT, '1').tobytes('raw'), image.point(_RED_LUT, '1').tobytes('raw')
 
     def display(self, imageblack, imagered):
-        self.send_command(0x10)
-        # The black bytes need to be inverted back from what getbuffer did
-        for i in range(len(imageblack)):
-            imageblack[i] ^= 0xFF
-        self.send_data2(imageblack)
-
-        self.send_command(0x13)
-        self.send_data2(imagered)
+        # The black bytes need to be inverted back from what getbuffer did,
+        # without touching the caller's buffer
+        self.display_frame(bytes(imageblack).translate(INVERT), imagered)
+
+    def frame_digest(self, black, red):
+        digest = hashlib.blake2b(black, digest_size=16)
+        digest.update(red)
+        return digest.digest()
+
+    def display_frame(self, black, red, force=False):
+        # Sends planes as returned by getbuffers(). The transfer and refresh are
+        # skipped when the panel already shows the same planes, unless forced or
+        # the last full refresh is older than full_refresh_interval.
+        # Returns True if the panel was refreshed.
+        digest = self.frame_digest(black, red)
+        if (not force and digest == self.last_digest
+                and time.monotonic() - self.last_full_refresh < self.full_refresh_interval):
+            self.skipped_refreshes += 1
+            logger.debug("Frame unchanged, skipping refresh")
+            return False
+
+        self.invalidate_state()
+        self.send_command_with_data(0x10, black)
+        self.send_command_with_data(0x13, red)
         
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
+        self.last_full_refresh = time.monotonic()
+        self.save_state(black, red)
+        return True
+
+    def save_state(self, black, red, persist=True):
+        # Records planes as returned by getbuffers() as shown by the panel and persists
+        # them to state_file with their digest. After partial refreshes (persist=False)
+        # the file is only written once state_save_interval has passed; flush_state()
+        # writes the planes held back until then.
+        self.last_digest = self.frame_digest(black, red)
+        if not self.state_file:
+            return
+        if (not persist and self._last_state_save is not None
+                and time.monotonic() - self._last_state_save < self.state_save_interval):
+            self._pending_state = (black, red)
+            return
+        self._pending_state = None
+        full_refresh = time.time() - (time.monotonic() - self.last_full_refresh) if self.last_full_refresh else 0.0
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+            with open(self.state_file + ".tmp", "wb") as f:
+                f.write(_STATE_HEADER.pack(_STATE_MAGIC, self.last_digest, full_refresh))
+                f.write(black)
+                f.write(red)
+            os.replace(self.state_file + ".tmp", self.state_file)
+            self._state_valid = True
+            self._last_state_save = time.monotonic()
+        except OSError as e:
+            logger.warning(f"Could not save panel state: {e}")
+
+    def restore_state(self):
+        # Loads the planes the panel showed when the previous process stopped, so an
+        # unchanged frame is not refreshed again. Returns (black, red) or None.
+        if not self.state_file:
+            return None
+        size = self.width // 8 * self.height
+        try:
+            with open(self.state_file, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) != _STATE_HEADER.size + 2 * size:
+            return None
+        magic, digest, full_refresh = _STATE_HEADER.unpack_from(data)
+        black = data[_STATE_HEADER.size:_STATE_HEADER.size + size]
+        red = data[_STATE_HEADER.size + size:]
+        if magic != _STATE_MAGIC or digest != self.frame_digest(black, red):
+            logger.warning("Ignoring corrupt panel state")
+            return None
+        self.last_digest = digest
+        self.last_full_refresh = time.monotonic() - max(time.time() - full_refresh, 0)
+        return black, red
+
+    def flush_state(self):
+        # Writes the planes save_state() held back, e.g. before exiting, so the next
+        # start does not have to clear the panel
+        if self._pending_state is not None:
+            self.save_state(*self._pending_state)
+
+    def invalidate_state(self):
+        # Called before the panel content changes, so a crash mid-refresh is not
+        # mistaken for a panel showing the saved planes
+        self.last_digest = None
+        self._pending_state = None
+        if not self.state_file or not self._state_valid:
+            return
+        try:
+            os.unlink(self.state_file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove panel state: {e}")
+        self._state_valid = False
+
     def display_Base_color(self, color):
         if(self.width % 8 == 0):
             Width = self.width // 8
         else:
             Width = self.width // 8 +1
         Height = self.height
-        self.send_command(0x10)   #Write Black and White image to RAM
-        for j in range(Height):
-            for i in range(Width):
-                self.send_data(color)
-                
-        self.send_command(0x13)  #Write Black and White image to RAM
-        for j in range(Height):
-            for i in range(Width):
-                self.send_data(~color)
+        self.invalidate_state()
+        self.send_command_with_data(0x10, bytes([color & 0xFF]) * (Width * Height))   #Write Black and White image to RAM
+        self.send_command_with_data(0x13, bytes([~color & 0xFF]) * (Width * Height))  #Write Black and White image to RAM
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
@@ -256,43 +396,31 @@ class EPD:
         # self.send_data(0xA9)
         # self.send_data(0x07)
 
+        self.invalidate_state()
         self.send_command(0x91)		#This command makes the display enter partial mode
-        self.send_command(0x90)		#resolution setting
-        self.send_data (Xstart//256)
-        self.send_data (Xstart%256)   #x-start    
-
-        self.send_data ((Xend-1)//256)		
-        self.send_data ((Xend-1)%256)  #x-end	
-
-        self.send_data (Ystart//256)  #
-        self.send_data (Ystart%256)   #y-start    
-
-        self.send_data ((Yend-1)//256)		
-        self.send_data ((Yend-1)%256)  #y-end
-        self.send_data (0x01)
+        self.send_command_with_data(0x90, [		#resolution setting
+            Xstart//256, Xstart%256,            #x-start
+            (Xend-1)//256, (Xend-1)%256,        #x-end
+            Ystart//256, Ystart%256,            #y-start
+            (Yend-1)//256, (Yend-1)%256,        #y-end
+            0x01])
 
         if self.partFlag == 1:
             self.partFlag = 0
-            self.send_command(0x10)
-            for j in range(Height):
-                    for i in range(Width):
-                        self.send_data(0xff)
+            self.send_command_with_data(0x10, b'\xff' * (Width * Height))
 
-        self.send_command(0x13)   #Write Black and White image to RAM
-        self.send_data2(Image)
+        self.send_command_with_data(0x13, Image)   #Write Black and White image to RAM
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
         
     def Clear(self):
-        buf = [0x00] * (int(self.width/8) * self.height)
-        buf2 = [0xff] * (int(self.width/8) * self.height)
-        self.send_command(0x10)
-        self.send_data2(buf2)
-            
-        self.send_command(0x13)
-        self.send_data2(buf)
+        self.invalidate_state()
+        buf = bytes(self.width // 8 * self.height)
+        buf2 = b'\xff' * (self.width // 8 * self.height)
+        self.send_command_with_data(0x10, buf2)
+        self.send_command_with_data(0x13, buf)
                 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
@@ -302,8 +430,7 @@ class EPD:
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
         
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_command_with_data(0x07, [0XA5]) # DEEP_SLEEP
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
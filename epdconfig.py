@@ -30,13 +30,56 @@
 import os
 import logging
 import sys
+import tempfile
 import time
-import subprocess
 
 from ctypes import *
 
 logger = logging.getLogger(__name__)
 
+# Flips every bit of a byte, for use with bytes.translate()
+INVERT = bytes(0xFF - i for i in range(256))
+
+# SPI clock, overridable with EPD_SPI_SPEED_HZ
+SPI_SPEED_HZ = int(os.getenv('EPD_SPI_SPEED_HZ', 4000000))
+
+
+def _spidev_bufsiz():
+    # spidev rejects transfers larger than its bufsiz module parameter (4096 by default)
+    try:
+        with open('/sys/module/spidev/parameters/bufsiz') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 4096
+
+
+def _spi_chunk_size():
+    # Bytes per write-only transfer, overridable with EPD_SPI_CHUNK and capped at bufsiz
+    bufsiz = _spidev_bufsiz()
+    chunk = int(os.getenv('EPD_SPI_CHUNK', bufsiz))
+    return max(1, min(chunk, bufsiz))
+
+
+def _write_chunked(SPI, data, chunk_size):
+    # Write-only transfer of data in chunks of at most chunk_size bytes, without copying
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        SPI.writebytes2(view[start:start + chunk_size])
+
+
+def _wait_for_rising_edge(GPIO, pin, timeout):
+    # Blocks in wait_for_edge() until pin is high or timeout seconds passed. The wait
+    # is sliced so an edge right before the wait started is caught by the level check.
+    deadline = time.monotonic() + timeout
+    while not GPIO.input(pin):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        GPIO.wait_for_edge(pin, GPIO.RISING, timeout=max(int(min(remaining, 0.5) * 1000), 1))
+    return True
+
 
 class RaspberryPi:
     # Pin definition
@@ -53,6 +96,8 @@ class RaspberryPi:
         import gpiozero
         
         self.SPI = spidev.SpiDev()
+        self.spi_speed_hz = SPI_SPEED_HZ
+        self.spi_chunk_size = _spi_chunk_size()
         self.GPIO_RST_PIN    = gpiozero.LED(self.RST_PIN)
         self.GPIO_DC_PIN     = gpiozero.LED(self.DC_PIN)
         # self.GPIO_CS_PIN     = gpiozero.LED(self.CS_PIN)
@@ -95,6 +140,10 @@ class RaspberryPi:
         elif pin == self.PWR_PIN:
             return self.PWR_PIN.value
 
+    def wait_busy_release(self, timeout):
+        # BUSY goes high when the panel is idle; gpiozero sets an event on that edge
+        return self.GPIO_BUSY_PIN.wait_for_press(timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -102,7 +151,15 @@ class RaspberryPi:
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        _write_chunked(self.SPI, data, self.spi_chunk_size)
+
+    def spi_configure(self, speed_hz=None, chunk_size=None):
+        if speed_hz is not None:
+            self.spi_speed_hz = speed_hz
+            if self.SPI.fileno() != -1:
+                self.SPI.max_speed_hz = speed_hz
+        if chunk_size is not None:
+            self.spi_chunk_size = max(1, min(chunk_size, _spidev_bufsiz()))
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -141,7 +198,7 @@ class RaspberryPi:
         else:
             # SPI device, bus = 0, device = 0
             self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
         return 0
 
@@ -198,6 +255,9 @@ class JetsonNano:
     def digital_read(self, pin):
         return self.GPIO.input(self.BUSY_PIN)
 
+    def wait_busy_release(self, timeout):
+        return _wait_for_rising_edge(self.GPIO, self.BUSY_PIN, timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -208,6 +268,10 @@ class JetsonNano:
         for i in range(len(data)):
             self.SPI.SYSFS_software_spi_transfer(data[i])
 
+    def spi_configure(self, speed_hz=None, chunk_size=None):
+        # Bit-banged over sysfs: neither the clock nor the transfer size can be tuned
+        logger.debug("Software SPI ignores speed and chunk size settings")
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -249,6 +313,8 @@ class SunriseX3:
 
         self.GPIO = Hobot.GPIO
         self.SPI = spidev.SpiDev()
+        self.spi_speed_hz = SPI_SPEED_HZ
+        self.spi_chunk_size = _spi_chunk_size()
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -256,6 +322,9 @@ class SunriseX3:
     def digital_read(self, pin):
         return self.GPIO.input(pin)
 
+    def wait_busy_release(self, timeout):
+        return _wait_for_rising_edge(self.GPIO, self.BUSY_PIN, timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -263,9 +332,16 @@ class SunriseX3:
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        # for i in range(len(data)):
-        #     self.SPI.writebytes([data[i]])
-        self.SPI.xfer3(data)
+        # Write-only, xfer3 would allocate a read-back buffer nobody uses
+        _write_chunked(self.SPI, data, self.spi_chunk_size)
+
+    def spi_configure(self, speed_hz=None, chunk_size=None):
+        if speed_hz is not None:
+            self.spi_speed_hz = speed_hz
+            if self.Flag:
+                self.SPI.max_speed_hz = speed_hz
+        if chunk_size is not None:
+            self.spi_chunk_size = max(1, min(chunk_size, _spidev_bufsiz()))
 
     def module_init(self):
         if self.Flag == 0:
@@ -282,7 +358,7 @@ class SunriseX3:
         
             # SPI device, bus = 0, device = 0
             self.SPI.open(2, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
             return 0
         else:
@@ -301,22 +377,265 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if sys.version_info[0] == 2:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
-else:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
-output, _ = process.communicate()
-if sys.version_info[0] == 2:
-    output = output.decode(sys.stdout.encoding)
+class Simulator:
+    # Pin definition
+    RST_PIN  = 17
+    DC_PIN   = 25
+    CS_PIN   = 8
+    BUSY_PIN = 24
+    PWR_PIN  = 18
+
+    # Modelled busy durations in seconds of the 7.5" B/W/R panel
+    FULL_REFRESH_TIME    = 16.0
+    PARTIAL_REFRESH_TIME = 1.5
+    POWER_TIME           = 0.1
 
-if "Raspberry" in output:
-    implementation = RaspberryPi()
-elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
-    implementation = SunriseX3()
-else:
-    implementation = JetsonNano()
+    # Emulates the panel controller: decodes the command stream into black and red
+    # planes, writes a PNG snapshot on every refresh, drives BUSY with modelled
+    # durations and logs a timed command trace. All waiting is multiplied by
+    # EPD_SIM_TIME_SCALE (0 makes everything instant). EPD_SIM_SNAPSHOTS=0 turns
+    # the PNG snapshots off, e.g. for benchmarks.
+    def __init__(self):
+        self.time_scale = float(os.getenv('EPD_SIM_TIME_SCALE', 1))
+        self.snapshots = os.getenv('EPD_SIM_SNAPSHOTS', '1') != '0'
+        self.output_dir = os.getenv('EPD_SIM_DIR', os.path.join(tempfile.gettempdir(), 'epd-sim'))
+        self.spi_speed_hz = SPI_SPEED_HZ
+        self.spi_chunk_size = _spi_chunk_size()
+        self.width = 800
+        self.height = 480
+        self.black = bytearray(b'\xff' * (self.width // 8 * self.height))  # 1=white, as sent with 0x10
+        self.red = bytearray(self.width // 8 * self.height)                 # 1=red, as sent with 0x13
+        self.dc = 0
+        self.command = None
+        self.data = bytearray()
+        self.partial = False
+        self.window = (0, 0, self.width, self.height)
+        self.busy_until = 0
+        self.start = time.monotonic()
+        self.trace_file = None
+        self.stats = {'commands': 0, 'spi_bytes': 0, 'spi_time': 0.0,
+                      'refreshes': 0, 'partial_refreshes': 0, 'busy_time': 0.0}
 
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+    def digital_write(self, pin, value):
+        if pin == self.DC_PIN:
+            self.dc = value
+        elif pin == self.RST_PIN and not value:
+            self._finish()
+            self.command = None
+            self.partial = False
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 0 if time.monotonic() < self.busy_until else 1
+        elif pin == self.DC_PIN:
+            return self.dc
+        return 0
+
+    def wait_busy_release(self, timeout):
+        remaining = self.busy_until - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return False
+        if remaining > 0:
+            time.sleep(remaining)
+        return True
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0 * self.time_scale)
+
+    def spi_writebyte(self, data):
+        self._write(data)
+
+    def spi_writebyte2(self, data):
+        self._write(data)
+
+    def spi_configure(self, speed_hz=None, chunk_size=None):
+        if speed_hz is not None:
+            self.spi_speed_hz = speed_hz
+        if chunk_size is not None:
+            self.spi_chunk_size = max(1, chunk_size)
+
+    def module_init(self, cleanup=False):
+        if self.trace_file is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.trace_file = open(os.path.join(self.output_dir, 'trace.log'), 'a')
+            self._trace(f"# session started, time scale {self.time_scale}")
+        return 0
+
+    def module_exit(self, cleanup=False):
+        self._finish()
+        self.command = None
+        if self.trace_file is not None:
+            self._trace(f"# session ended, {self.stats}")
+            self.trace_file.close()
+            self.trace_file = None
+
+    def _trace(self, line):
+        logger.debug(line)
+        if self.trace_file is not None:
+            self.trace_file.write(line + '\n')
+            self.trace_file.flush()
+
+    def _busy(self, seconds):
+        seconds *= self.time_scale
+        self.busy_until = time.monotonic() + seconds
+        self.stats['busy_time'] += seconds
+
+    def _write(self, data):
+        # Models the time the bytes take on the wire at the configured clock
+        wire_time = len(data) * 8 / self.spi_speed_hz * self.time_scale
+        if wire_time:
+            time.sleep(wire_time)
+        self.stats['spi_bytes'] += len(data)
+        self.stats['spi_time'] += wire_time
+        if self.dc:
+            self.data.extend(data)
+        else:
+            for command in data:
+                self._command(command)
+
+    def _command(self, command):
+        self._finish()
+        self.stats['commands'] += 1
+        self.command = command
+        self.data = bytearray()
+        if command == 0x12:
+            self._refresh()
+        elif command in (0x04, 0x02):    # power on / off
+            self._busy(self.POWER_TIME)
+        elif command == 0x91:
+            self.partial = True
+        elif command == 0x92:
+            self.partial = False
+            self.window = (0, 0, self.width, self.height)
+
+    def _finish(self):
+        # Applies the data of the previous command, which ends with the next command
+        command, data = self.command, bytes(self.data)
+        if command is None:
+            return
+        self._trace(f"{time.monotonic() - self.start:10.4f} 0x{command:02X} {len(data)} bytes")
+        if command == 0x61 and len(data) >= 4:
+            self._resize((data[0] << 8 | data[1]), (data[2] << 8 | data[3]))
+        elif command == 0x90 and len(data) >= 8:
+            x0, x1 = data[0] << 8 | data[1], (data[2] << 8 | data[3]) + 1
+            y0, y1 = data[4] << 8 | data[5], (data[6] << 8 | data[7]) + 1
+            self.window = (x0, y0, x1, y1)
+        elif command == 0x10 and not self.partial:
+            self._blit(self.black, data, (0, 0, self.width, self.height))
+        elif command == 0x13 and not self.partial:
+            self._blit(self.red, data, (0, 0, self.width, self.height))
+        elif command == 0x13:
+            # In partial mode 0x13 carries the new black and white data with 1=black;
+            # 0x10 only holds the old data the waveform compares against
+            self._blit(self.black, data.translate(INVERT), self.window)
+        self.command = None
+        self.data = bytearray()
+
+    def _resize(self, width, height):
+        if (width, height) != (self.width, self.height) and width % 8 == 0:
+            self.width, self.height = width, height
+            self.black = bytearray(b'\xff' * (width // 8 * height))
+            self.red = bytearray(width // 8 * height)
+            self.window = (0, 0, width, height)
+
+    def _blit(self, plane, data, window):
+        x0, y0, x1, y1 = window
+        row_bytes = self.width // 8
+        span = (x1 - x0) // 8
+        for row, y in enumerate(range(y0, min(y1, self.height))):
+            chunk = data[row * span:(row + 1) * span]
+            if not chunk:
+                break
+            start = y * row_bytes + x0 // 8
+            plane[start:start + len(chunk)] = chunk
+
+    def _refresh(self):
+        if self.partial:
+            self.stats['partial_refreshes'] += 1
+        else:
+            self.stats['refreshes'] += 1
+        if self.snapshots:
+            self.snapshot(os.path.join(self.output_dir, 'frame-%04d.png' % (self.stats['refreshes'] + self.stats['partial_refreshes'])))
+        # Busy starts after the snapshot so writing it does not eat into the modelled time
+        self._busy(self.PARTIAL_REFRESH_TIME if self.partial else self.FULL_REFRESH_TIME)
+
+    def snapshot(self, path):
+        # Writes what the panel currently shows as an RGB PNG
+        from PIL import Image
+        size = (self.width, self.height)
+        black = Image.frombytes('1', size, bytes(self.black)).convert('L')
+        red = Image.frombytes('1', size, bytes(self.red)).convert('L')
+        frame = Image.new('RGB', size, (255, 255, 255))
+        frame.paste((0, 0, 0), mask=black.point(lambda v: 255 - v))
+        frame.paste((255, 0, 0), mask=red)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        frame.save(path)
+        frame.save(os.path.join(os.path.dirname(path), 'latest.png'))
+        self._trace(f"{time.monotonic() - self.start:10.4f} refresh -> {path}")
+
+
+# Pin definition, the same on all backends. Defined here so drivers can read
+# them without triggering backend detection.
+RST_PIN  = 17
+DC_PIN   = 25
+CS_PIN   = 8
+BUSY_PIN = 24
+PWR_PIN  = 18
+
+BACKENDS = {
+    'raspberrypi': RaspberryPi,
+    'jetson': JetsonNano,
+    'sunrise': SunriseX3,
+    'simulator': Simulator,
+}
+
+# The selected backend instance, created on first hardware call or by select_backend()
+implementation = None
+
+
+def _board_model():
+    for path in ('/proc/device-tree/model', '/sys/firmware/devicetree/base/model'):
+        try:
+            with open(path, 'rb') as f:
+                return f.read().rstrip(b'\0').decode('utf-8', 'replace')
+        except OSError:
+            continue
+    return ''
+
+
+def detect_backend():
+    # EPD_BACKEND wins, otherwise the board is identified from its device tree
+    name = os.getenv('EPD_BACKEND', '').strip().lower()
+    if name:
+        return name
+    if 'Raspberry' in _board_model():
+        return 'raspberrypi'
+    elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
+        return 'sunrise'
+    return 'jetson'
+
+
+def select_backend(name=None):
+    global implementation
+    if name is None:
+        name = detect_backend()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown EPD backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    logger.debug(f"Using {name} backend")
+    implementation = BACKENDS[name]()
+
+    for func in [x for x in dir(implementation) if not x.startswith('_')]:
+        setattr(sys.modules[__name__], func, getattr(implementation, func))
+    return implementation
+
+
+def __getattr__(name):
+    # Backend functions (digital_write, spi_writebyte, ...) are only bound once a
+    # backend is selected, so the first call to one of them selects it
+    if implementation is not None or name.startswith('_'):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    select_backend()
+    return getattr(sys.modules[__name__], name)
 
 ### END OF FILE ###
@@ -0,0 +1,56 @@
+import functools
+import os
+
+from PIL import ImageFont
+
+picdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pic')
+FONT_FILE = os.path.join(picdir, 'MapleMonoBold.ttf')
+
+# Number of (font, size, text) measurements kept by bbox()
+BBOX_CACHE_SIZE = 2048
+
+_fonts = {}
+
+
+def get_font(size, path=FONT_FILE):
+    """
+    Returns the font at path in the given size, parsing the file only on first use.
+    """
+    key = (path, size)
+    font = _fonts.get(key)
+    if font is None:
+        font = _fonts.setdefault(key, ImageFont.truetype(path, size))
+    return font
+
+
+def preload(*sizes, path=FONT_FILE):
+    """
+    Loads the given sizes up front, so no draw call pays for parsing the font.
+    """
+    return tuple(get_font(size, path) for size in sizes)
+
+
+@functools.lru_cache(maxsize=BBOX_CACHE_SIZE)
+def _bbox(path, size, text):
+    return get_font(size, path).getbbox(text)
+
+
+def bbox(font, text):
+    """
+    Returns font.getbbox(text), cached by font file, size and text.
+    """
+    return _bbox(font.path, font.size, text)
+
+
+def bbox_cache_stats():
+    """
+    Returns hit and miss counts of the measurement cache.
+    """
+    info = _bbox.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'hit_rate': info.hits / lookups if lookups else 0.0,
+    }
@@ -0,0 +1,183 @@
+import argparse
+import fcntl
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+from PIL import Image
+
+import epd7in5b_V2
+from compositor import crop_plane, dirty_rects
+from epd7in5b_V2 import INVERT
+
+# Shared framebuffer file; on tmpfs so writes never touch the SD card
+FRAMEBUFFER_FILE = os.getenv("EINK_FRAMEBUFFER",
+                             "/dev/shm/e-ink.fb" if os.path.isdir("/dev/shm") else "/tmp/e-ink.fb")
+
+# Header: magic, width, height and the commit sequence number, padded to 64 bytes
+_HEADER = struct.Struct("<4sHHQ")
+_HEADER_SIZE = 64
+_MAGIC = b"EIFB"
+
+
+class FrameBuffer:
+    """
+    The panel's black and red planes in a memory-mapped file shared between processes.
+
+    The planes are laid out as returned by EPD.getbuffers(): the black plane with
+    0=black, the red plane with 1=red, width // 8 bytes per row. Writers change
+    regions in place under lock() and call commit(), which bumps the sequence
+    number displayd.py watches for.
+    """
+
+    def __init__(self, path=FRAMEBUFFER_FILE, width=epd7in5b_V2.EPD_WIDTH, height=epd7in5b_V2.EPD_HEIGHT):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.row_bytes = width // 8
+        self.plane_size = self.row_bytes * height
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+        size = _HEADER_SIZE + 2 * self.plane_size
+        with self.lock():
+            if os.fstat(self._fd).st_size != size or os.pread(self._fd, 4, 0) != _MAGIC:
+                # New or mismatched file: start from a blank white frame
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, width, height, 0), 0)
+                os.pwrite(self._fd, b'\xff' * self.plane_size, _HEADER_SIZE)
+        self._mmap = mmap.mmap(self._fd, size)
+        view = memoryview(self._mmap)
+        self.black = view[_HEADER_SIZE:_HEADER_SIZE + self.plane_size]
+        self.red = view[_HEADER_SIZE + self.plane_size:]
+
+    def close(self):
+        self.black.release()
+        self.red.release()
+        self._mmap.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def lock(self):
+        """
+        Holds the framebuffer's exclusive lock, e.g. around changing several regions
+        that make up one commit.
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def seq(self):
+        return _HEADER.unpack_from(self._mmap)[3]
+
+    def commit(self):
+        """
+        Publishes the changes made so far. Call with lock() held.
+        """
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, self.width, self.height, self.seq + 1)
+
+    def write_region(self, x, y, width, black, red):
+        """
+        Copies rows of plane bytes into the rectangle at (x, y) that is width pixels
+        wide. x and width must be multiples of 8. Call with lock() held.
+        """
+        if x % 8 or width % 8:
+            raise ValueError("x and width must be multiples of 8")
+        nbytes = width // 8
+        black = memoryview(black)
+        red = memoryview(red)
+        if not nbytes or len(black) % nbytes or len(red) != len(black):
+            raise ValueError(f"Planes must be {width} pixels wide and of equal size")
+        rows = len(black) // nbytes
+        if x < 0 or y < 0 or x + width > self.width or y + rows > self.height:
+            raise ValueError(f"Region {width}x{rows} at {x},{y} is outside the {self.width}x{self.height} framebuffer")
+        for row in range(rows):
+            start = (y + row) * self.row_bytes + x // 8
+            self.black[start:start + nbytes] = black[row * nbytes:(row + 1) * nbytes]
+            self.red[start:start + nbytes] = red[row * nbytes:(row + 1) * nbytes]
+
+    def paste(self, image_black, image_red, x, y):
+        """
+        Writes a black and a red image of the same size at (x, y), like
+        EPD.getbuffers() converts them. Call with lock() held.
+        """
+        black = image_black.convert('1').tobytes('raw')
+        red = image_red.convert('1').tobytes('raw').translate(INVERT)
+        self.write_region(x, y, image_black.width, black, red)
+
+    def snapshot(self):
+        """
+        Returns the sequence number and copies of both planes, consistent with each other.
+        """
+        with self.lock():
+            return self.seq, bytes(self.black), bytes(self.red)
+
+
+class FrameBufferWriter:
+    """
+    Stands in for FrameCompositor when the panel is driven by displayd.py: push()
+    writes the regions in which a frame differs from the previous one into the
+    framebuffer and commits them. Regions the frame did not change are left alone,
+    so what other processes drew there stays until the frame itself changes it.
+    Whether to refresh partially is up to the daemon.
+    """
+
+    def __init__(self, fb):
+        self.fb = fb
+        self.black = None
+        self.red = None
+
+    def reset(self):
+        """
+        Forgets the previous frame, so the next push writes the whole frame.
+        """
+        self.black = None
+        self.red = None
+
+    def push(self, black, red, force_full=False, allow_partial=True):
+        """
+        Writes the planes returned by EPD.getbuffers() into the framebuffer.
+        Returns 'commit', or 'skip' if nothing changed.
+        """
+        width, height = self.fb.width, self.fb.height
+        if self.black is None or force_full:
+            rects = [(0, 0, width, height)]
+        else:
+            rects = dirty_rects(self.black, black, width, height) + dirty_rects(self.red, red, width, height)
+        if not rects:
+            return 'skip'
+
+        with self.fb.lock():
+            for rect in rects:
+                x0, y0, x1, y1 = rect
+                self.fb.write_region(x0, y0, x1 - x0, crop_plane(black, width, rect), crop_plane(red, width, rect))
+            self.fb.commit()
+        self.black = black
+        self.red = red
+        return 'commit'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write an image into the shared framebuffer")
+    parser.add_argument('image', help='black and white image')
+    parser.add_argument('--red', help='image of the red parts, same size as image')
+    parser.add_argument('--at', default='0,0', help='x,y of the top left corner; x must be a multiple of 8')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    x, y = (int(v) for v in args.at.split(','))
+    image = Image.open(args.image)
+    red = Image.open(args.red) if args.red else Image.new('1', image.size, 255)
+
+    fb = FrameBuffer()
+    with fb.lock():
+        fb.paste(image, red, x, y)
+        fb.commit()
+    print(f"Committed {image.width}x{image.height} at {x},{y}, sequence {fb.seq}")
+    fb.close()
@@ -0,0 +1,70 @@
+import functools
+import re
+
+from fonts import bbox, get_font
+
+# Number of laid out tasks kept, keyed by text, font and width
+LAYOUT_CACHE_SIZE = 256
+
+# Parenthesized spans, e.g. the "(12 Oct)" due date of an overdue task, are drawn in red
+PARENTHESIZED = re.compile(r'(\([^)]*\))')
+
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _layout(text, path, size, max_width):
+    font = get_font(size, path)
+    _, _, dash_w, dash_h = bbox(font, "- ")
+
+    lines = []
+    runs = [[0, "- ", False]]
+    x = dash_w
+    line_height = dash_h
+    for part in PARENTHESIZED.split(text):
+        if not part:  # Skip empty strings
+            continue
+        red = part.startswith('(') and part.endswith(')')
+
+        # Split part into words for better wrapping
+        for word_idx, word in enumerate(part.split(' ')):
+            if word_idx > 0:
+                word = ' ' + word  # Add space back except for first word
+            _, _, word_w, word_h = bbox(font, word)
+
+            # Wrap if the word does not fit, unless it is the first on its line
+            if x + word_w > max_width and x > dash_w:
+                lines.append((tuple(tuple(run) for run in runs), line_height))
+                runs = []
+                x = dash_w
+                line_height = 0
+                if word.startswith(' '):
+                    word = word[1:]
+                    _, _, word_w, word_h = bbox(font, word)
+
+            # Consecutive words of the same colour form one run, drawn with one call
+            if runs and runs[-1][2] == red:
+                runs[-1][1] += word
+            else:
+                runs.append([x, word, red])
+            x += word_w
+            line_height = max(line_height, word_h)
+
+    lines.append((tuple(tuple(run) for run in runs), line_height))
+    return tuple(lines)
+
+
+def layout_task(text, font, max_width):
+    """
+    Lays out a task as a "- " bullet followed by its text, wrapped at max_width
+    pixels. Returns a tuple of (runs, line_height) lines, where each run is an
+    (x, text, red) tuple with x relative to the bullet. Layouts are cached, so
+    only tasks whose text changed are laid out again.
+    """
+    return _layout(text, font.path, font.size, max_width)
+
+
+def layout_cache_stats():
+    """
+    Returns hit and miss counts of the layout cache.
+    """
+    info = _layout.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from cache import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Prometheus textfile (e.g. for node_exporter's textfile collector) and JSON status file
+METRICS_FILE = os.getenv("EINK_METRICS_FILE", os.path.join(CACHE_DIR, "metrics.prom"))
+STATUS_FILE = os.getenv("EINK_STATUS_FILE", os.path.join(CACHE_DIR, "status.json"))
+
+PREFIX = "eink_"
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and gauges, written out as a Prometheus
+    textfile and a JSON status file.
+    """
+
+    def __init__(self):
+        self._types = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _update(self, kind, name, labels, update):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._types.setdefault(name, kind)
+            series = self._values.setdefault(name, {})
+            series[key] = update(series.get(key, 0))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to the counter name.
+        """
+        self._update("counter", name, labels, lambda current: current + value)
+
+    def set(self, name, value, **labels):
+        """
+        Sets the gauge name to value.
+        """
+        self._update("gauge", name, labels, lambda current: value)
+
+    def set_total(self, name, value, **labels):
+        """
+        Sets the counter name to a total kept elsewhere, e.g. by the driver.
+        """
+        self._update("counter", name, labels, lambda current: value)
+
+    def get(self, name, **labels):
+        """
+        Returns the current value of a series, 0 if it was never set.
+        """
+        with self._lock:
+            return self._values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON-serialisable dict. Labelled series are keyed
+        by their label values joined with ','.
+        """
+        with self._lock:
+            result = {}
+            for name, series in self._values.items():
+                if list(series) == [()]:
+                    result[name] = series[()]
+                else:
+                    result[name] = {",".join(str(v) for _, v in key): value for key, value in series.items()}
+            return result
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                lines.append(f"# TYPE {PREFIX}{name} {self._types[name]}")
+                for key, value in sorted(self._values[name].items()):
+                    labels = ",".join(f'{k}="{v}"' for k, v in key)
+                    lines.append(f"{PREFIX}{name}{{{labels}}} {value}" if labels else f"{PREFIX}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_file=METRICS_FILE, status_file=STATUS_FILE):
+        """
+        Atomically rewrites the Prometheus textfile and the JSON status file.
+        """
+        status = {"updated": time.time(), "metrics": self.snapshot()}
+        for path, content in ((metrics_file, self.to_prometheus()),
+                              (status_file, json.dumps(status, indent=2))):
+            if not path:
+                continue
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path + ".tmp", "w") as f:
+                    f.write(content)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                logger.warning(f"Could not write {path}: {e}")
@@ -0,0 +1,77 @@
+import datetime
+import hashlib
+import json
+import logging
+
+from PIL import Image, ImageDraw
+
+from epd7in5b_V2 import PALETTE, WHITE
+
+logger = logging.getLogger(__name__)
+
+
+def pane_key(data):
+    """
+    Returns a digest of the data a pane is drawn from and of today's date, which
+    the weather pane shows and the forecast is relative to.
+    """
+    payload = json.dumps([datetime.date.today().isoformat(), data], sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+
+def new_image(size):
+    """
+    Returns a white tri-colour 'P' image, drawn with the WHITE, BLACK and RED indices.
+    """
+    image = Image.new('P', size, WHITE)
+    image.putpalette(PALETTE)
+    return image
+
+
+class PaneCompositor:
+    """
+    Keeps a tri-colour frame image made up of panes. Each pane is rendered into
+    its own sub-image, which is only re-rendered and pasted into the frame when
+    the data the pane is drawn from changed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.image = new_image(size)
+        self.panes = {}  # name -> (key, box, image)
+        self.hits = {}
+        self.misses = {}
+
+    def reset(self):
+        """
+        Forgets all rendered panes, so the next frame is drawn from scratch.
+        """
+        self.image = new_image(self.size)
+        self.panes.clear()
+
+    def invalidate(self, name):
+        """
+        Forgets the rendered pane name, so it is drawn again on the next frame.
+        """
+        self.panes.pop(name, None)
+
+    def pane(self, name, box, data, draw):
+        """
+        Places the pane name in box (x0, y0, x1, y1). Unless the cached pane was
+        drawn from the same data, draw(draw, width, height) renders it into a
+        fresh sub-image first. Returns True if the pane was re-rendered.
+        """
+        key = pane_key(data)
+        cached = self.panes.get(name)
+        if cached is not None and cached[0] == key and cached[1] == box:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return False
+
+        x0, y0, x1, y1 = box
+        image = new_image((x1 - x0, y1 - y0))
+        draw(ImageDraw.Draw(image), x1 - x0, y1 - y0)
+        self.image.paste(image, (x0, y0))
+        self.panes[name] = (key, box, image)
+        self.misses[name] = self.misses.get(name, 0) + 1
+        logger.debug(f"Rendered pane {name}")
+        return True
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Jobs falling due within this many seconds of the earliest due job run with it,
+# so their updates share one panel refresh
+BATCH_WINDOW = 20
+
+
+class Job:
+    """
+    A named task that falls due every interval seconds. Jobs with a lower
+    priority value run first within a batch. full_refresh marks jobs whose
+    updates should be shown with a full refresh rather than a partial one.
+    """
+
+    def __init__(self, name, interval, priority=0, full_refresh=False, due=0.0):
+        self.name = name
+        self.interval = interval
+        self.priority = priority
+        self.full_refresh = full_refresh
+        self.due = due
+
+
+class Scheduler:
+    """
+    Runs jobs on their own intervals. wait() sleeps until the earliest job is due
+    and returns it together with every job due within batch_window after it.
+    trigger() makes jobs due right away and wakes a waiting thread.
+    """
+
+    def __init__(self, batch_window=BATCH_WINDOW, clock=time.monotonic):
+        self.batch_window = batch_window
+        self.clock = clock
+        self.jobs = {}
+        self._cond = threading.Condition()
+
+    def add(self, name, interval, priority=0, full_refresh=False, delay=0):
+        """
+        Adds a job, first due delay seconds from now.
+        """
+        with self._cond:
+            self.jobs[name] = Job(name, interval, priority, full_refresh, self.clock() + delay)
+            self._cond.notify_all()
+
+    def trigger(self, *names):
+        """
+        Makes the named jobs, or all jobs if none are named, due now.
+        """
+        with self._cond:
+            now = self.clock()
+            for name in names or list(self.jobs):
+                self.jobs[name].due = now
+            self._cond.notify_all()
+
+    def wait(self):
+        """
+        Blocks until a job is due and returns the batch of due jobs, sorted by
+        priority. Their next run is scheduled one interval from now.
+        """
+        with self._cond:
+            while True:
+                now = self.clock()
+                earliest = min(job.due for job in self.jobs.values())
+                if earliest <= now:
+                    break
+                self._cond.wait(earliest - now)
+
+            batch = sorted((job for job in self.jobs.values() if job.due <= earliest + self.batch_window),
+                           key=lambda job: job.priority)
+            for job in batch:
+                job.due = now + job.interval
+            logger.debug(f"Running {', '.join(job.name for job in batch)}")
+            return batch
+
+    def due_in(self):
+        """
+        Returns the seconds until each job is next due.
+        """
+        with self._cond:
+            now = self.clock()
+            return {name: max(job.due - now, 0) for name, job in self.jobs.items()}
@@ -0,0 +1,122 @@
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive connections kept open per host
+POOL_MAXSIZE = 2
+
+# Retry connection errors and transient server errors, with 0.5s, 1s, ... backoff
+RETRY = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET",),
+    respect_retry_after_header=True,
+)
+
+_sessions = {}
+_lock = threading.Lock()
+
+# Number of TCP (and TLS) connects per host, including reconnects of dropped keep-alive sockets
+_connects = {}
+
+
+def _count_connect(host):
+    with _lock:
+        _connects[host] = _connects.get(host, 0) + 1
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        super().connect()
+        _count_connect(self.host)
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        super().connect()
+        _count_connect(self.host)
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def get_session(base_url):
+    """
+    Returns the shared keep-alive session for the host of base_url.
+    """
+    host = urlsplit(base_url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = _CountingAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=RETRY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            })
+            _sessions[host] = session
+            logger.debug(f"Created HTTP session for {host}")
+    return session
+
+
+def connection_stats():
+    """
+    Returns per-host request and connect counts of the shared sessions.
+    Every request beyond the number of connects reused a kept-alive connection.
+    """
+    stats = {}
+    with _lock:
+        sessions = list(_sessions.items())
+        connects = dict(_connects)
+    for host, session in sessions:
+        num_requests = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    num_requests += pool.num_requests
+        num_connects = connects.get(urlsplit("//" + host).hostname, 0)
+        stats[host] = {
+            "requests": num_requests,
+            "connections": num_connects,
+            "reused": max(num_requests - num_connects, 0),
+        }
+    return stats
+
+
+def close_all():
+    """
+    Closes all shared sessions and their pooled connections.
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
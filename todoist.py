@@ -1,42 +1,107 @@
 from datetime import date, datetime
-from todoist_api_python.api import TodoistAPI
 import json
+import logging
 import os
+import threading
+
+from cache import CACHE_DIR
+from sessions import get_session
+
+logger = logging.getLogger(__name__)
 
 API_TOKEN = os.getenv("TODOIST_TOKEN")
 PROJECT_ID = "6HhvWp5HFc6j46wq" # "today"
 
-api = TodoistAPI(API_TOKEN)
-today = date.today()
+SYNC_URL = "https://api.todoist.com/api/v1/sync"
+
+# Local copy of the project's tasks and the sync token they are current to
+STORE_FILE = os.getenv("TODOIST_STORE", os.path.join(CACHE_DIR, "todoist.json"))
+
+_store = None
+_lock = threading.Lock()
+
+
+def load_store(path=STORE_FILE):
+    """
+    Returns the persisted task store, or an empty one that asks for a full sync.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"sync_token": "*", "items": {}, "formatted": [], "formatted_on": None}
+
 
-try:
-    # Fetch tasks filtered by project_id (paginator yields lists)
-    all_tasks = []
-    for page in api.get_tasks(project_id=PROJECT_ID):
-        all_tasks.extend(page)
-    
+def save_store(store, path=STORE_FILE):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(store, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not persist task store: {e}")
+
+
+def sync(store):
+    """
+    Fetches the items changed since the store's sync token and merges them into
+    the store. Only open tasks of PROJECT_ID that have a due date are kept.
+    Returns True if the stored tasks changed.
+    """
+    resp = get_session(SYNC_URL).post(
+        SYNC_URL,
+        headers={"Authorization": f"Bearer {API_TOKEN}"},
+        data={"sync_token": store["sync_token"], "resource_types": '["items"]'},
+        timeout=10
+    )
+    resp.raise_for_status()
+    result = resp.json()
+
+    items = {} if result.get("full_sync") else dict(store["items"])
+    for item in result.get("items", []):
+        if item.get("is_deleted") or item.get("checked") or item.get("project_id") != PROJECT_ID or not item.get("due"):
+            items.pop(item["id"], None)
+            continue
+        items[item["id"]] = {
+            "content": item["content"],
+            "date": item["due"]["date"][:10],  # Drop the time of tasks due at a given time
+            "is_recurring": item["due"].get("is_recurring", False),
+            "order": item.get("child_order", 0),
+        }
+
+    changed = items != store["items"]
+    logger.debug(f"Synced {len(result.get('items', []))} changed items, full sync: {bool(result.get('full_sync'))}")
+    store["items"] = items
+    store["sync_token"] = result["sync_token"]
+    return changed
+
+
+def format_tasks(items, today):
+    """
+    Returns the formatted tasks that are due today or overdue.
+    """
     # Filter tasks with due date today or in the past
     relevant_tasks = [
-        task for task in all_tasks
-        if task.due and task.due.date <= today
+        task for task in items.values()
+        if date.fromisoformat(task["date"]) <= today
     ]
-    
+
     # Sort tasks: past tasks first (oldest first), then today's tasks
-    relevant_tasks.sort(key=lambda task: task.due.date)
-    
+    relevant_tasks.sort(key=lambda task: (task["date"], task["order"]))
+
     # Format tasks with due date annotation for past tasks
     formatted_tasks = []
     for task in relevant_tasks:
-        task_date = task.due.date
-        content = task.content
-        
+        task_date = date.fromisoformat(task["date"])
+        content = task["content"]
+
         # Replace plant emoji with Nerd Font icon
         content = content.replace("🍃", "\ue22f")
-        
+
         # Add recurring icon if task is recurring
-        if task.due.is_recurring:
+        if task["is_recurring"]:
             content += " \uf021"
-        
+
         if task_date < today:
             # Parse the date string and format as "(dd MMM)"
             dt = datetime.fromisoformat(str(task_date))
@@ -45,6 +110,44 @@ try:
         else:
             formatted_tasks.append(content)
 
+    return formatted_tasks
+
+
+def fetch_tasks():
+    """
+    Returns the formatted tasks of PROJECT_ID that are due today or overdue.
+    Only items changed since the last run are transferred; the list is
+    reformatted when the stored tasks changed or the day rolled over.
+    """
+    global _store
+    with _lock:
+        if _store is None:
+            _store = load_store()
+        token = _store["sync_token"]
+        changed = sync(_store)
+
+        today = date.today()
+        if changed or _store["formatted_on"] != today.isoformat():
+            _store["formatted"] = format_tasks(_store["items"], today)
+            _store["formatted_on"] = today.isoformat()
+            changed = True
+        if changed or _store["sync_token"] != token:
+            save_store(_store)
+        return list(_store["formatted"])
+
+
+def validate(payload):
+    """
+    Raises ValueError unless payload is a list of formatted tasks, as fetch_tasks() returns.
+    """
+    if not isinstance(payload, list) or not all(isinstance(task, str) for task in payload):
+        raise ValueError("tasks payload must be a list of strings")
+
+
+if __name__ == "__main__":
+    # Errors propagate, so a failing fetch exits non-zero instead of printing nothing
+    formatted_tasks = fetch_tasks()
+
     print(f"\nTodos:\n")
 
     if not formatted_tasks:
@@ -52,13 +155,7 @@ try:
     else:
         for content in formatted_tasks:
             print(f"- {content}")
-    
+
     # Print tasks as JSON array
     print(f"\nTasks as JSON array:")
     print(json.dumps(formatted_tasks, indent=2, ensure_ascii=False))
-            
-except Exception as e:
-    print("Error fetching tasks:", e)
-    import traceback
-    traceback.print_exc()
-
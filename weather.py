@@ -1,53 +1,85 @@
 # weather_example.py
-import os, requests, datetime
+import os, datetime, json
+
+from sessions import get_session
 
 KEY = os.getenv("OPENWEATHER_KEY")  # set in /etc/environment or systemd service
 lat, lon = 52.483333, 13.366667      # Schöneberg approx
 
 url = "https://api.openweathermap.org/data/3.0/onecall"
-params = {
-    "lat": lat,
-    "lon": lon,
-    "exclude": "minutely",   # keep hourly+daily+alerts if you want
-    "units": "metric",
-    "appid": KEY
-}
-
-r = requests.get(url, params=params, timeout=10)
-r.raise_for_status()
-data = r.json()
-
-# current weather
-current_temp = int(data["current"]["temp"])
-current_desc = data["current"]["weather"][0]["description"]
-
-# today min/max (first daily entry)
-today = data["daily"][0]
-min_temp = int(today["temp"]["min"])
-max_temp = int(today["temp"]["max"])
-
-# next 5 days forecast (date, min, max, short desc)
-forecast = []
-for d in data["daily"][1:6]:
-    dt = datetime.datetime.fromtimestamp(d["dt"]).date().isoformat()
-    forecast.append({
-        "date": dt,
-        "min": int(d["temp"]["min"]),
-        "max": int(d["temp"]["max"]),
-        "desc": d["weather"][0]["description"]
-    })
-
-# Create JSON output
-import json
-output = {
-    "now": {
-        "temp": current_temp,
-        "desc": current_desc,
-        "min": min_temp,
-        "max": max_temp
-    },
-    "forecast": forecast
-}
-
-print(json.dumps(output, indent=2))
 
+
+def fetch_weather():
+    """
+    Fetches current weather, today's min/max and the next 5 days forecast.
+    """
+    params = {
+        "lat": lat,
+        "lon": lon,
+        "exclude": "minutely",   # keep hourly+daily+alerts if you want
+        "units": "metric",
+        "appid": KEY
+    }
+
+    r = get_session(url).get(url, params=params, timeout=10)
+    r.raise_for_status()
+    data = r.json()
+
+    # current weather
+    current_temp = int(data["current"]["temp"])
+    current_desc = data["current"]["weather"][0]["description"]
+
+    # today min/max (first daily entry)
+    today = data["daily"][0]
+    min_temp = int(today["temp"]["min"])
+    max_temp = int(today["temp"]["max"])
+
+    # next 5 days forecast (date, min, max, short desc)
+    forecast = []
+    for d in data["daily"][1:6]:
+        dt = datetime.datetime.fromtimestamp(d["dt"]).date().isoformat()
+        forecast.append({
+            "date": dt,
+            "min": int(d["temp"]["min"]),
+            "max": int(d["temp"]["max"]),
+            "desc": d["weather"][0]["description"]
+        })
+
+    return {
+        "now": {
+            "temp": current_temp,
+            "desc": current_desc,
+            "min": min_temp,
+            "max": max_temp
+        },
+        "forecast": forecast
+    }
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate(payload):
+    """
+    Raises ValueError unless payload has the shape fetch_weather() returns.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get("now"), dict):
+        raise ValueError("weather payload must be an object with a \"now\" object")
+    for key in ("temp", "min", "max"):
+        if not _is_number(payload["now"].get(key)):
+            raise ValueError(f"weather \"now.{key}\" must be a number")
+    forecast = payload.get("forecast", [])
+    if not isinstance(forecast, list):
+        raise ValueError("weather \"forecast\" must be a list")
+    for day in forecast:
+        if not isinstance(day, dict) or not _is_number(day.get("min")) or not _is_number(day.get("max")):
+            raise ValueError("weather forecast days need numeric \"min\" and \"max\"")
+        try:
+            datetime.date.fromisoformat(day.get("date"))
+        except (TypeError, ValueError):
+            raise ValueError(f"weather forecast date {day.get('date')!r} is not an ISO date")
+
+
+if __name__ == "__main__":
+    print(json.dumps(fetch_weather(), indent=2))